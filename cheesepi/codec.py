@@ -0,0 +1,185 @@
+""" Copyright (c) 2015, Swedish Institute of Computer Science
+  All rights reserved.
+  Redistribution and use in source and binary forms, with or without
+  modification, are permitted provided that the following conditions are met:
+	  * Redistributions of source code must retain the above copyright
+		notice, this list of conditions and the following disclaimer.
+	  * Redistributions in binary form must reproduce the above copyright
+		notice, this list of conditions and the following disclaimer in the
+		documentation and/or other materials provided with the distribution.
+	  * Neither the name of The Swedish Institute of Computer Science nor the
+		names of its contributors may be used to endorse or promote products
+		derived from this software without specific prior written permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+ WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+ DISCLAIMED. IN NO EVENT SHALL THE SWEDISH INSTITUTE OF COMPUTER SCIENCE BE LIABLE
+ FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+ (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Authors: ljjm@sics.se
+Testers:
+Description: Compact encodings of measurement values, shared by the client
+and the server. Delay sequences are packed as little endian float32 after
+a version byte, and put in text fields (influx, JSON dumps) as base64
+behind a "b64:" prefix. Sequences written by older clients, the string
+representation of a list, are still decoded.
+
+Dumped series can also be stored column by column (see pack_columns()):
+a magic string and version byte, the length of a JSON header and the
+header itself (series name, row count and the name, type and size of each
+column), followed by each column's data. Integer and float columns are
+packed 64 bit values, delay columns packed float32s, anything else JSON.
+"""
+
+import json
+import base64
+import struct
+from array import array
+
+DELAYS_VERSION = 1 # first byte of packed delays
+TEXT_PREFIX    = "b64:"
+
+_HEADER = struct.Struct("<B")
+
+COLUMNS_MAGIC   = b"CPCOL"
+COLUMNS_VERSION = 1
+_COLUMNS_HEADER = struct.Struct("<5sBI") # magic, version, header length
+_NO_DELAYS = 0xffffffff # delay count of a row without delays
+
+
+def pack_delays(delays):
+	"""Packed bytes of a sequence of delays, for binary fields (e.g. BSON)"""
+	delays = list(delays)
+	return _HEADER.pack(DELAYS_VERSION) + struct.pack("<%df" % len(delays), *delays)
+
+def unpack_delays(data):
+	"""Delays (an array of doubles) of the bytes from pack_delays()"""
+	data = bytes(data)
+	version = _HEADER.unpack_from(data)[0]
+	if version != DELAYS_VERSION:
+		raise ValueError("Unknown delay encoding version %d" % version)
+	count = (len(data) - _HEADER.size) // 4
+	return array("d", struct.unpack_from("<%df" % count, data, _HEADER.size))
+
+def encode_delays(delays):
+	"""Text form of a sequence of delays, for text and JSON fields"""
+	return TEXT_PREFIX + base64.b64encode(pack_delays(delays)).decode("ascii")
+
+def decode_delays(value):
+	"""Delays of any of the encodings: packed bytes (including a BSON
+	Binary), the text form of encode_delays(), the string representation
+	of a list (older clients) or an already decoded sequence"""
+	if isinstance(value, bytearray):
+		return unpack_delays(value)
+	if not isinstance(value, basestring):
+		return value
+	if value.startswith(TEXT_PREFIX):
+		return unpack_delays(base64.b64decode(value[len(TEXT_PREFIX):]))
+	if isinstance(value, bytes) and value[:1] == _HEADER.pack(DELAYS_VERSION):
+		return unpack_delays(value)
+	# The repr of a list of numbers is JSON, fall back to evaluating it as
+	# a Python literal for anything else
+	try:
+		return json.loads(value)
+	except ValueError:
+		import ast
+		return ast.literal_eval(value)
+
+
+## Column oriented series
+def is_columns(prefix):
+	"""Do the first bytes of a file start a pack_columns() series?"""
+	return prefix[:len(COLUMNS_MAGIC)] == COLUMNS_MAGIC
+
+def _column_type(values):
+	if len(values) == 0:
+		return "json"
+	numbers = True
+	integers = True
+	for v in values:
+		if isinstance(v, bool) or not isinstance(v, (int, long, float)):
+			numbers = False
+			break
+		if not isinstance(v, (int, long)) or not -2**63 <= v < 2**63:
+			integers = False
+	if numbers:
+		return "i8" if integers else "f8"
+	if all(v is None or (isinstance(v, basestring) and v.startswith(TEXT_PREFIX))
+	       for v in values):
+		return "delays"
+	return "json"
+
+def _pack_column(column_type, values):
+	if column_type == "i8":
+		return struct.pack("<%dq" % len(values), *values)
+	if column_type == "f8":
+		return struct.pack("<%dd" % len(values), *values)
+	if column_type == "delays":
+		counts = []
+		delays = []
+		for v in values:
+			if v is None:
+				counts.append(_NO_DELAYS)
+			else:
+				row = decode_delays(v)
+				counts.append(len(row))
+				delays.extend(row)
+		return (struct.pack("<%dI" % len(counts), *counts) +
+		        struct.pack("<%df" % len(delays), *delays))
+	return json.dumps(values).encode("utf-8")
+
+def _unpack_column(column_type, data, rows):
+	if column_type == "i8":
+		return list(struct.unpack("<%dq" % rows, data))
+	if column_type == "f8":
+		return list(struct.unpack("<%dd" % rows, data))
+	if column_type == "delays":
+		counts = struct.unpack_from("<%dI" % rows, data)
+		offset = 4 * rows
+		values = []
+		for count in counts:
+			if count == _NO_DELAYS:
+				values.append(None)
+				continue
+			values.append(array("d", struct.unpack_from("<%df" % count, data, offset)))
+			offset += 4 * count
+		return values
+	return json.loads(data.decode("utf-8"))
+
+def pack_columns(name, columns, values):
+	"""Bytes of series name, with the given column names and rows of
+	values, stored column by column"""
+	header = {'name': name, 'rows': len(values), 'columns': []}
+	blocks = []
+	for i, column in enumerate(columns):
+		column_values = [row[i] for row in values]
+		column_type = _column_type(column_values)
+		block = _pack_column(column_type, column_values)
+		header['columns'].append({'name': column, 'type': column_type, 'size': len(block)})
+		blocks.append(block)
+	header = json.dumps(header).encode("utf-8")
+	return (_COLUMNS_HEADER.pack(COLUMNS_MAGIC, COLUMNS_VERSION, len(header)) +
+	        header + b"".join(blocks))
+
+def read_columns(fd):
+	"""Read a pack_columns() series from file fd, returns its name, the
+	column names and a list of each column's values"""
+	magic, version, header_size = _COLUMNS_HEADER.unpack(fd.read(_COLUMNS_HEADER.size))
+	if magic != COLUMNS_MAGIC:
+		raise ValueError("Not a column oriented series")
+	if version != COLUMNS_VERSION:
+		raise ValueError("Unknown column format version %d" % version)
+	header = json.loads(fd.read(header_size).decode("utf-8"))
+	names = []
+	columns = []
+	for column in header['columns']:
+		names.append(column['name'])
+		columns.append(_unpack_column(column['type'], fd.read(column['size']),
+		                              header['rows']))
+	return header['name'], names, columns
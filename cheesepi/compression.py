@@ -0,0 +1,181 @@
+""" Copyright (c) 2015, Swedish Institute of Computer Science
+  All rights reserved.
+  Redistribution and use in source and binary forms, with or without
+  modification, are permitted provided that the following conditions are met:
+	  * Redistributions of source code must retain the above copyright
+		notice, this list of conditions and the following disclaimer.
+	  * Redistributions in binary form must reproduce the above copyright
+		notice, this list of conditions and the following disclaimer in the
+		documentation and/or other materials provided with the distribution.
+	  * Neither the name of The Swedish Institute of Computer Science nor the
+		names of its contributors may be used to endorse or promote products
+		derived from this software without specific prior written permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+ WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+ DISCLAIMED. IN NO EVENT SHALL THE SWEDISH INSTITUTE OF COMPUTER SCIENCE BE LIABLE
+ FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+ (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Authors: ljjm@sics.se
+Testers:
+Description: Compression codecs for upload archives. The client picks one
+(see the Upload task's 'compression' spec), the collector recognises it
+from the archive's first bytes. gzip and bzip2 are always available, xz
+needs the lzma module (backports.lzma on Python 2) and zstd the
+zstandard module.
+"""
+
+import gzip
+import bz2
+import tarfile
+from contextlib import contextmanager
+
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+CODECS = ["gz", "bz2", "xz", "zstd", "none"]
+DEFAULT_LEVELS = {"gz": 6, "bz2": 9, "xz": 6, "zstd": 3}
+
+# First bytes of each compressed format
+MAGIC = [
+	("gz",   b"\x1f\x8b"),
+	("bz2",  b"BZh"),
+	("xz",   b"\xfd7zXZ\x00"),
+	("zstd", b"\x28\xb5\x2f\xfd"),
+]
+MAGIC_SIZE = 6
+
+# tarfile itself reads these (and uncompressed archives) with random access
+TARFILE_CODECS = ["gz", "bz2", "none"]
+
+
+def available(codec):
+	"""Can this host compress and decompress with codec?"""
+	if codec=="xz":
+		return lzma!=None
+	if codec=="zstd":
+		return zstandard!=None
+	return codec in CODECS
+
+class CompressorWriter(object):
+	"""Writable file object compressing into fd with a compressor object
+	(compress() and flush()), close() does not close fd"""
+	def __init__(self, fd, compressor):
+		self.fd = fd
+		self.compressor = compressor
+
+	def write(self, data):
+		self.fd.write(self.compressor.compress(data))
+
+	def close(self):
+		self.fd.write(self.compressor.flush())
+		self.fd.flush()
+
+class DecompressorReader(object):
+	"""Readable file object decompressing what is read from fd"""
+	def __init__(self, fd, decompressor):
+		self.fd = fd
+		self.decompressor = decompressor
+		self.buffer = b""
+		self.position = 0 # of the next byte to read in buffer
+		self.eof = False
+
+	def read(self, size=-1):
+		while not self.eof and (size < 0 or len(self.buffer)-self.position < size):
+			data = self.fd.read(65536)
+			if not data:
+				self.eof = True
+				break
+			self.buffer = self.buffer[self.position:] + self.decompressor.decompress(data)
+			self.position = 0
+		end = len(self.buffer) if size < 0 else self.position+size
+		data = self.buffer[self.position:end]
+		self.position = self.position + len(data)
+		return data
+
+	def close(self):
+		pass
+
+def compressor(fd, codec="gz", level=None):
+	"""Writable file object that compresses into fd. close() it (which
+	leaves fd open) to finish the compressed stream"""
+	if not available(codec):
+		raise ValueError("Compression codec not available: "+str(codec))
+	if level==None:
+		level = DEFAULT_LEVELS.get(codec)
+	if codec=="gz":
+		return gzip.GzipFile(fileobj=fd, mode="wb", compresslevel=level)
+	if codec=="bz2":
+		return CompressorWriter(fd, bz2.BZ2Compressor(level))
+	if codec=="xz":
+		return CompressorWriter(fd, lzma.LZMACompressor(preset=level))
+	if codec=="zstd":
+		return CompressorWriter(fd, zstandard.ZstdCompressor(level=level).compressobj())
+	return CompressorWriter(fd, _Identity())
+
+class _Identity(object):
+	def compress(self, data):
+		return data
+	def flush(self):
+		return b""
+	def decompress(self, data):
+		return data
+
+def detect(prefix):
+	"""Codec of data starting with the bytes prefix"""
+	for codec, magic in MAGIC:
+		if prefix.startswith(magic):
+			return codec
+	return "none"
+
+def detect_file(filename):
+	with open(filename, 'rb') as fd:
+		return detect(fd.read(MAGIC_SIZE))
+
+def decompressor(fd, codec):
+	"""Readable file object of the data compressed with codec in fd"""
+	if not available(codec):
+		raise ValueError("Compression codec not available: "+str(codec))
+	if codec=="gz":
+		return gzip.GzipFile(fileobj=fd, mode="rb")
+	if codec=="bz2":
+		return DecompressorReader(fd, bz2.BZ2Decompressor())
+	if codec=="xz":
+		return DecompressorReader(fd, lzma.LZMADecompressor())
+	if codec=="zstd":
+		return DecompressorReader(fd, zstandard.ZstdDecompressor().decompressobj())
+	return fd
+
+@contextmanager
+def open_tar(filename):
+	"""Open a tar archive compressed with any of the codecs for reading,
+	yields (tar, random_access). Without random access the archive is a
+	stream: each member must be read before moving on to the next, and
+	its file object can not seek backwards."""
+	codec = detect_file(filename)
+	if codec in TARFILE_CODECS:
+		with tarfile.open(filename) as tar:
+			yield tar, True
+		return
+	with open(filename, 'rb') as fd:
+		tar = tarfile.open(fileobj=decompressor(fd, codec), mode="r|")
+		try:
+			yield tar, False
+		finally:
+			tar.close()
@@ -32,6 +32,7 @@ a local config file (if one does not exist, and initialising logging options
 import sys
 import os
 import logging
+import hashlib
 
 import cheesepi as cp
 
@@ -45,6 +46,9 @@ cheesepi_dir = os.path.dirname(os.path.realpath(__file__))
 log_dir      = home_dir
 config_file  = os.path.join(cheesepi_dir, "cheesepi.conf")
 
+# Where incremental dumps have got to
+dump_marks_file = os.path.join(home_dir, ".cheesepi.dump_marks")
+
 # Store log in user's home directory
 log_file    = os.path.join(log_dir, ".cheesepi.log")
 if not os.access(log_file, os.W_OK):
@@ -100,6 +104,15 @@ def update_logging():
 		root_logger.addHandler(out_handler)
 
 def get_dao():
+	dao = get_database_dao()
+	flush_size = int(get('write_buffer') or 0)
+	if flush_size > 0:
+		spool_file = os.path.join(log_dir, get('spool_file') or ".cheesepi.spool")
+		flush_interval = float(get('write_buffer_interval') or 10)
+		return cp.storage.dao_buffered.DAO_buffered(dao, spool_file, flush_size, flush_interval)
+	return dao
+
+def get_database_dao():
 	if config_equal('database',"mongo"):
 		return cp.storage.dao_mongo.DAO_mongo()
 	elif config_equal('database',"influx08"):
@@ -113,7 +126,7 @@ def get_dao():
 	# and so on for other database engines...
 
 	msg = "Fatal error: 'database' type not set to a valid value in config file, exiting."
-	logger.error("Database type: "+config['database']+"\n"+msg)
+	logger.error("Database type: "+str(get('database'))+"\n"+msg)
 	exit(1)
 
 def generate_uuid():
@@ -160,9 +173,49 @@ def read_config():
 		sys.exit(1)
 	return lines
 
+class Snapshot(dict):
+	"""Read only view of the parsed config file, replaced (not changed)
+	when the file is reloaded"""
+	def __init__(self, values, mtime):
+		dict.__init__(self, values)
+		self.mtime = mtime
+		# signatures are md5(secret + data), so hash the secret only once
+		self.signer = hashlib.md5(values.get('secret', ""))
+
+	def sign(self, data):
+		"""md5 hex digest of the local secret followed by data"""
+		md5 = self.signer.copy()
+		md5.update(data)
+		return md5.hexdigest()
+
+	def read_only(self, *args, **kwargs):
+		raise TypeError("Config snapshot is read only")
+	__setitem__ = __delitem__ = read_only
+	clear = pop = popitem = setdefault = update = read_only
+
+def config_mtime():
+	try:
+		return os.stat(config_file).st_mtime
+	except OSError:
+		return None
+
+def invalidate_config(signum=None, frame=None):
+	"""Reparse the config file on next use, can be a SIGHUP handler"""
+	global config
+	config = None
+
 def get_config():
+	"""Return the config snapshot, reparsing the file only if it has
+	been modified (or invalidate_config() was called)"""
+	global config
+	if config is None or config.mtime != config_mtime():
+		config = parse_config()
+	return config
+
+def parse_config():
 	import re
 	config = {}
+	mtime  = config_mtime()
 	lines  = read_config()
 	for line in lines:
 		# strip comment and badly formed lines
@@ -177,7 +230,7 @@ def get_config():
 	config['cheesepi_dir'] = cheesepi_dir
 	config['config_file']  = config_file
 	config['version']      = version()
-	return config
+	return Snapshot(config, mtime)
 
 
 def create_default_schedule(schedule_filename):
@@ -199,7 +252,7 @@ def create_default_schedule(schedule_filename):
 
 def load_local_schedule():
 	import json
-	schedule_filename = os.path.join(cheesepi_dir, config['schedule'])
+	schedule_filename = os.path.join(cheesepi_dir, get('schedule'))
 	if not os.path.isfile(schedule_filename):
 		create_default_schedule(schedule_filename)
 
@@ -279,6 +332,26 @@ def get_last_dumped(dao=None):
 	# convert to seconds
 	return last_dumped
 
+def get_dump_marks():
+	"""Per series marks of where each successfully uploaded dump
+	ended, in the database's own time unit (see DAO.resume_mark())"""
+	import json
+	try:
+		with open(dump_marks_file) as f:
+			return json.load(f)
+	except IOError:
+		return {}
+	except ValueError as e:
+		logger.error("Corrupt dump marks file %s: %s" % (dump_marks_file, e))
+		return {}
+
+def set_dump_marks(marks):
+	import json
+	tmp_file = dump_marks_file+".tmp"
+	with open(tmp_file, "w") as f:
+		json.dump(marks, f)
+	os.rename(tmp_file, dump_marks_file) # never leave a partial file
+
 def get_dump_period():
 	"""How frequently should we dump?"""
 	return 86400
@@ -303,13 +376,13 @@ def copyfile(from_file, to_file, replace={}):
 
 
 def get_controller():
-	if "controller" in config:
-		return config['controller']
+	if config_defined('controller'):
+		return get('controller')
 	else:
 		return "http://cheesepi.sics.se"
 
 def get_cheesepi_dir():
-	return config['cheesepi_dir']
+	return get('cheesepi_dir')
 
 def make_databases():
 	cmd = get_cheesepi_dir()+"/install/make_influx_DBs.sh"
@@ -322,16 +395,13 @@ def version():
 		return f.read().strip()
 
 def get(key):
-	key = clean(key)
-	if key in config:
-		return config[key]
-	return None
+	return get_config().get(clean(key))
 
 def get_landmarks():
 	"""Who shall we ping/httping?"""
 	if not config_defined('landmarks'):
 		return []
-	landmark_string = config['landmarks']
+	landmark_string = get('landmarks')
 	landmarks = landmark_string.split()
 	return landmarks
 
@@ -341,27 +411,15 @@ def get_dashboard_port():
 
 def config_defined(key):
 	"""Is the specified key defined and true in the config object?"""
-	key = clean(key)
-	if key in config:
-		return True
-	return False
+	return clean(key) in get_config()
 
 def config_equal(key, value):
 	"""Is the specified key equal to the given value?"""
-	key   = clean(key)
-	value = clean(value)
-	if key in config:
-		if config[key]==value:
-			return True
-	return False
+	return get_config().get(clean(key))==clean(value)
 
 def config_true(key):
 	"""Is the specified key defined and true in the config object?"""
-	key = clean(key)
-	if key in config:
-		if config[key]=="true":
-			return True
-	return False
+	return get_config().get(clean(key))=="true"
 
 
 # clean the identifiers
@@ -371,12 +429,13 @@ def clean(id):
 def main():
 	from pprint import PrettyPrinter
 	printer = PrettyPrinter(indent=4)
-	printer.pprint(config)
+	printer.pprint(get_config())
 
 
 
 # Some accounting to happen on every import (mostly for config file making)
-config = get_config()
+config = None
+get_config()
 update_logging()
 
 if __name__ == "__main__":
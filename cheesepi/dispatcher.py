@@ -3,6 +3,7 @@
 import os
 import time
 import sys
+import importlib
 import multiprocessing
 import logging
 from sched import scheduler
@@ -25,7 +26,30 @@ repeat_schedule = True # keep rescheuling?
 schedule_list = []
 
 pool = None # pool must be global, yet instantiated in __main__
-pool_size = 5 # max number of concurrent tasks...
+default_pool_size = 5 # max number of concurrent tasks, unless set in config
+
+# Prebuilt Task objects, keyed by the hash of their spec. Both the
+# scheduling process and each pool worker keep their own cache
+task_cache = {}
+# DAO connection kept warm by each pool worker (set by init_worker)
+worker_dao = None
+
+# 'spread' scheduling mode: tasks competing for the uplink, of which
+# only heavy_task_limit may run at once
+HEAVY_TASKS = ['dash', 'throughput', 'iperf']
+default_heavy_task_limit = 1
+heavy_slots = None # semaphore shared with the pool workers
+defer_delay   = 60 # seconds to wait before retrying a deferred task
+max_deferrals = 5  # run anyway after being deferred this many times
+
+# Dispatcher engine, either 'sched' (a blocking scheduler handing every task
+# to the process pool) or 'twisted' (an event loop running task commands as
+# child processes, and only handing CPU heavy tasks to the pool)
+engine = "sched"
+# Tasks written with Twisted, that run directly on the reactor
+REACTOR_TASKS = ['beacon', 'updatetasks']
+# Tasks always run in the process pool
+POOL_TASKS = HEAVY_TASKS + ['upload', 'upgradecode']
 
 # Task priority
 IMPORTANT = 1
@@ -38,10 +62,114 @@ def timestamp(): return (time.time()-start_time)
 def print_queue(): logger.debug(s.queue)
 
 
+def get_pool_size():
+	"""How many worker processes should execute tasks?"""
+	try:
+		return int(cp.config.get('pool_size'))
+	except (TypeError, ValueError):
+		return default_pool_size
+
+def spec_hash(spec):
+	"""Stable identifier for a task specification"""
+	import json
+	import hashlib
+	return hashlib.md5(json.dumps(spec, sort_keys=True)).hexdigest()
+
+def get_task(dao, spec):
+	"""Return the prebuilt Task for spec, building it on first use.
+	The spec of a cached task is reset to how it was when built, so
+	fields recorded by a previous run do not leak into the next"""
+	import copy
+	key = spec_hash(spec)
+	if key not in task_cache:
+		task = cp.utils.build_task(dao, copy.deepcopy(spec))
+		if task == None:
+			return None
+		task_cache[key] = (task, copy.deepcopy(task.spec))
+	task, built_spec = task_cache[key]
+	task.spec = copy.deepcopy(built_spec)
+	return task
+
+def init_worker(slots=None):
+	"""Run once in each pool worker, claim a DAO connection to reuse"""
+	global worker_dao
+	global heavy_slots
+	# forget any tasks inherited from the parent, they use its DAO
+	task_cache.clear()
+	worker_dao = cp.config.get_dao()
+	heavy_slots = slots
+
+def get_engine():
+	"""Which dispatcher engine should we use?"""
+	if not cp.config.config_equal('dispatcher_engine', "twisted"):
+		return "sched"
+	try:
+		importlib.import_module('twisted.internet.reactor')
+	except ImportError:
+		logger.error("Twisted not installed, falling back to the sched dispatcher engine")
+		return "sched"
+	return "twisted"
+
+def enter(delay, action, args):
+	"""Call action(*args) in delay seconds, using the engine's event queue"""
+	if engine=="twisted":
+		from twisted.internet import reactor
+		reactor.callLater(max(delay, 0), action, *args)
+	else:
+		s.enter(delay, NORMAL, action, args)
+
+def spread_mode():
+	"""Should tasks be spread out, rather than aligned to their offsets?"""
+	return cp.config.config_equal('schedule_mode', "spread")
+
+def get_heavy_task_limit():
+	try:
+		return int(cp.config.get('heavy_task_limit'))
+	except (TypeError, ValueError):
+		return default_heavy_task_limit
+
+def get_max_load():
+	"""Load average (as measured by the Status task) above which to defer"""
+	try:
+		return float(cp.config.get('max_load'))
+	except (TypeError, ValueError):
+		return float(multiprocessing.cpu_count())
+
+def host_jitter(spec, period):
+	"""Offset into the period that is fixed for this host and task,
+	so hosts (and tasks on the same host) do not all fire together"""
+	import hashlib
+	digest = hashlib.md5(cp.utils.get_host_id()+spec_hash(spec)).hexdigest()
+	return int(digest, 16) % int(period)
+
+def is_heavy(task):
+	return task.spec['taskname'] in HEAVY_TASKS
+
+def defer_reason(task):
+	"""Return why this task should not start now, None if it may start.
+	A heavy task that may start is holding one of the heavy_slots"""
+	if task.spec['taskname']=="status":
+		return None # measuring the load is its job
+	if os.getloadavg()[0] > get_max_load():
+		return "load"
+	if is_heavy(task) and not heavy_slots.acquire(False):
+		return "bandwidth"
+	return None
+
 # Need to catch Ctrl+C, and so wrap the Interupt as an Exception
-def async(task):
-	"""Wrapper around asynchronous task execution"""
+def async(spec, annotations=None, holds_slot=False, needs_slot=False):
+	"""Wrapper around asynchronous task execution. A task that needs_slot
+	waits for one of the heavy_slots before it starts"""
+	if needs_slot:
+		heavy_slots.acquire()
+		holds_slot = True
 	try:
+		task = get_task(worker_dao, spec)
+		if task == None:
+			logger.error("Task specification not valid: "+str(spec))
+			return
+		# record any scheduling deferrals with the stored op
+		task.spec.update(annotations or {})
 		task.run()
 	except KeyboardInterrupt:
 		pass # probably just user destruction
@@ -54,12 +182,89 @@ def async(task):
 		print "Unhandled exception %s (%s):\n%s" % (cls.__name__, exc, traceback.format_exc())
 		logger.error("Unhandled exception %s (%s):\n%s" % (cls.__name__, exc, traceback.format_exc()))
 		raise Exception("Unhandled exception: %s (%s)" % (cls.__name__, exc))
+	finally:
+		if holds_slot:
+			heavy_slots.release()
+		# pool workers are terminated without running atexit, so do not
+		# leave the task's ops buffered
+		try:
+			worker_dao.flush()
+		except Exception as e:
+			logger.error("Flushing the task's ops failed: "+str(e))
+
+def log_failure(failure, spec):
+	logger.error("Task %s failed: %s" % (spec, failure.getTraceback()))
+
+def run_event_driven(spec, annotations):
+	"""Run a task from the reactor: its command() as a child process,
+	Twisted tasks natively, and anything else in the reactor's threadpool"""
+	import copy
+	from twisted.internet import defer, threads, utils, reactor
+	task = get_task(dao, spec)
+	if task == None:
+		logger.error("Task specification not valid: "+str(spec))
+		return defer.succeed(None)
+	# a copy, in case the previous run of this spec is still going
+	task = copy.copy(task)
+	task.spec.update(annotations)
+
+	command = task.command()
+	if command != None:
+		def execute(resolved):
+			start_time = cp.utils.now()
+			def record(output):
+				out, err, return_code = output
+				# parsing and storing may block on the database
+				return threads.deferToThread(task.record, return_code, out,
+					start_time, cp.utils.now())
+			d = utils.getProcessOutputAndValue("/bin/sh", ["-c", command], env=os.environ)
+			d.addCallback(record)
+			return d
+		# look up the hostnames first, without blocking the reactor
+		d = defer.DeferredList([reactor.resolve(h) for h in task.hostnames()],
+			consumeErrors=True)
+		d.addCallback(execute)
+	elif task.spec['taskname'] in REACTOR_TASKS:
+		d = defer.maybeDeferred(task.run)
+	else:
+		d = threads.deferToThread(task.run)
+	d.addErrback(log_failure, spec)
+	return d
+
+def dispatch(task, spec, annotations, holds_slot, needs_slot=False):
+	"""Hand the task over to be executed by the engine"""
+	if engine=="twisted" and task.spec['taskname'] not in POOL_TASKS:
+		run_event_driven(spec, annotations)
+		return
+	# only the spec is shipped, the worker has its own prebuilt task
+	pool.apply_async(async, args=[spec, annotations, holds_slot, needs_slot], callback=log_result)
 
 # Perform a scheduled Task, and schedule the next
-def run(task, spec):
+def run(task, spec, annotations=None):
 	"""Run this task asychronously, and schedule the next period"""
 	#logger.info("Running %s @ %f" % (task.spec['taskname'], timestamp()))
-	pool.apply_async(async, args=[task], callback=log_result)
+	if annotations==None:
+		annotations = {'scheduled_time': time.time()}
+	holds_slot = False
+	needs_slot = False
+	if spread_mode():
+		reason = defer_reason(task)
+		deferrals = annotations.get('deferrals', 0)
+		if reason!=None and deferrals < max_deferrals:
+			logger.info("Deferring %s (%s), %d times so far" % (task.spec['taskname'], reason, deferrals))
+			annotations['deferrals'] = deferrals + 1
+			annotations['deferral_reasons'] = annotations.get('deferral_reasons', [])+[reason]
+			enter(defer_delay, run, [task, spec, annotations])
+			return
+		holds_slot = is_heavy(task) and reason==None
+		# deferred too often, the worker waits for a slot rather than
+		# running beside the heavy tasks holding them
+		needs_slot = is_heavy(task) and not holds_slot
+	if 'deferrals' in annotations:
+		annotations['deferred'] = time.time() - annotations['scheduled_time']
+		annotations['deferral_reasons'] = ",".join(annotations['deferral_reasons'])
+	del annotations['scheduled_time']
+	dispatch(task, spec, annotations, holds_slot, needs_slot)
 	if repeat_schedule:
 		schedule_task(spec)
 
@@ -67,26 +272,33 @@ def run(task, spec):
 def schedule_task(spec):
 	"""Ensure task defiend by specificaiton is executed"""
 	import math
-	task = cp.utils.build_task(dao, spec)
+	task = get_task(dao, spec)
 	if task == None:
 		logger.error("Task specification not valid: "+str(spec))
 		return
 
 	if task.spec['period']==0: return # dummy task
+	offset = task.spec['offset']
+	if spread_mode():
+		offset = (offset + host_jitter(spec, task.spec['period'])) % task.spec['period']
 	next_period = 1 + math.floor(time.time() / task.spec['period'])
-	abs_start = (next_period*task.spec['period']) + task.spec['offset']
+	abs_start = (next_period*task.spec['period']) + offset
 	delay = abs_start-time.time()
 	#logger.debug("Time calculations: %d\t%f\t%f" % (next_period,abs_start,delay))
 	# queue up a task, include spec for next period
-	s.enter(delay, NORMAL, run, [task, spec])
+	enter(delay, run, [task, spec])
 
 def get_queue():
 	"""return list of queued task objects"""
 	q=[]
-	for t in s.queue:
-		start_time = t.time
+	if engine=="twisted":
+		from twisted.internet import reactor
+		events = [(c.getTime(), c.args) for c in reactor.getDelayedCalls() if c.func==run]
+	else:
+		events = [(t.time, t.argument) for t in s.queue]
+	for start_time, argument in events:
 		# extract the dict of the first parameter to the event
-		spec = t.argument[0].toDict()
+		spec = argument[0].toDict()
 		spec['start_time'] = start_time
 		q.append(spec)
 	return q
@@ -109,23 +321,53 @@ def print_schedule(schedule_list):
 	for t in schedule_list:
 		print t
 
-def HUP():
+def HUP(signum, frame):
 	"""Reload config if we receive a HUP signal"""
 	global pool
 	print "Reloading..."
-	pool.terminate()
+	cp.config.invalidate_config()
+	if pool is not None:
+		pool.terminate()
+	if engine=="twisted":
+		from twisted.internet import reactor
+		if reactor.running:
+			# the reactor cannot be run again, just replace its tasks
+			reactor.callFromThread(reschedule)
+			return
 	start()
 
-def start():
+def reschedule():
+	"""Drop the queued tasks, and schedule those of the reloaded config"""
+	from twisted.internet import reactor
+	for call in reactor.getDelayedCalls():
+		if call.func==run:
+			call.cancel()
+	schedule_all()
+
+def schedule_all():
+	"""Create the pool, and schedule all tasks of the schedule"""
 	global pool
+	global heavy_slots
 	schedule_list = load_schedule()
 	print_schedule(schedule_list)
-	pool = multiprocessing.Pool(processes=pool_size)
+	task_cache.clear()
+	heavy_slots = multiprocessing.BoundedSemaphore(get_heavy_task_limit())
+	pool = multiprocessing.Pool(processes=get_pool_size(),
+		initializer=init_worker, initargs=[heavy_slots])
 	cp.utils.make_series()
 	# reschedule all tasks from the schedule specified in config file
 	for t in schedule_list:
 		schedule_task(t)
-	s.run()
+
+def start():
+	global engine
+	engine = get_engine()
+	schedule_all()
+	if engine=="twisted":
+		from twisted.internet import reactor
+		reactor.run()
+	else:
+		s.run()
 	if pool is not None:
 		pool.close()
 		pool.join()
@@ -24,3 +24,6 @@ class UnsupportedResultType(CheesePiServerException):
 
 class UnsupportedEntityType(CheesePiServerException):
     pass
+
+class UploadProcessingError(CheesePiServerException):
+    pass
@@ -49,7 +49,11 @@ class CheeseRPCServer(MsgpackRPCServer):
         self.log.error("{error}\n{traceback}",
                        error=error, traceback=traceback.format_exc(error))
     def __init__(self, dao):
+        from cheesepi.server.scheduling.EntitySampler import EntitySampler
+        from cheesepi.server.scheduling.PriorityCache import PriorityCache
         self.dao = dao
+        self.sampler = EntitySampler.shared(dao)
+        self.priorities = PriorityCache.shared(dao)
 
     def _response(self, status, body):
         if status == True:
@@ -88,6 +92,8 @@ class CheeseRPCServer(MsgpackRPCServer):
             entity = PeerEntity(host, peer_uuid)
             #result = yield self.dao.register_entity(peer_uuid, host, 'peer')
             result = yield self.dao.register_peer_entity(entity)
+            # Make it schedulable straight away
+            self.sampler.add(entity)
             #self.log.info("register with result: {result}",result=result)
             defer.returnValue(self._response(True, result))
         except Exception as e:
@@ -133,7 +139,9 @@ class CheeseRPCServer(MsgpackRPCServer):
             #self.log.info("Someone trying to get schedule for {}".format(data['uuid']))
 
             from cheesepi.server.scheduling.PingScheduler import PingScheduler
-            ps = PingScheduler(data['uuid'])
+            ps = PingScheduler(data['uuid'], dao=self.dao, sampler=self.sampler,
+                               priorities=self.priorities,
+                               priority=data.get('priority', 'variance'))
 
             if 'method' in data:
                 method = data['method']
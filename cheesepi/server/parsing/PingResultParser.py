@@ -6,19 +6,20 @@ from .ResultParser import ResultParser
 
 from cheesepi.server.storage.mongo import MongoDAO
 from cheesepi.server.storage.models.result import Result
+from cheesepi.codec import decode_delays
 
 class PingResultParser(ResultParser):
 	log = logging.getLogger("cheesepi.server.parsing.PingResultParser")
 
-	# Takes an object parsed from json
-	def __init__(self, obj):
+	# Takes the column names of a ping series and an iterable of its rows
+	def __init__(self, columns, rows):
 		self._parsed = False
-		self._input_obj = obj
-		self._result_set = []
+		self._columns = columns
+		self._rows = rows
+		self._result_objects = []
 		self._peer_id = None
 
 	def __enter__(self):
-		self.parse()
 		return self
 
 	def __exit__(self, exc_type, exc_value, traceback):
@@ -30,17 +31,40 @@ class PingResultParser(ResultParser):
 		and handle any resulting errors in a sane way. Should ALWAYS
 		return an output that can be directly inserted into the database.
 		"""
-		inp = self._input_obj
-		result_objects = []
-
-		columns = inp[0]['series'][0]['columns']
-		#from pprint import pformat
-		#self.log.info("\n{}".format(pformat(columns)))
+		self._result_objects = list(self.iter_results())
+		self._parsed = True
+		return self._result_objects
 
-		entries = [entry for entry in inp[0]['series'][0]['values']]
-		for entry in entries:
+	def iter_results(self):
+		"""
+		Yields a PingResult per row, decoding rows only as they are needed.
+		The rows can only be iterated once.
+		"""
+		# Resolve column positions once, missing columns read as None
+		index = dict((name, i) for i, name in enumerate(self._columns))
+		def column(name):
+			i = index.get(name)
+			if i is None:
+				return lambda entry: None
+			return lambda entry: entry[i]
+		peer_id_of = column('peer_id')
+		delays_of = column('delays')
+		landmark_of = column('landmark')
+		target_id_of = column('target_id')
+		address_of = column('destination_address')
+		start_time_of = column('start_time')
+		end_time_of = column('end_time')
+		ping_count_of = column('ping_count')
+		packet_loss_of = column('packet_loss')
+		packet_size_of = column('packet_size')
+		max_rtt_of = column('maximum_RTT')
+		min_rtt_of = column('minimum_RTT')
+		avg_rtt_of = column('average_RTT')
+		stddev_rtt_of = column('stddev_RTT')
+
+		for entry in self._rows:
 			# TODO THIS IS NOT IMPLEMENTED ON CLIENT SIDE, MIGHT CHANGE
-			peer_id = self._peer_id = entry[columns.index('peer_id')]
+			peer_id = peer_id_of(entry)
 			if self._peer_id is None:
 				self._peer_id = peer_id
 			elif self._peer_id != peer_id:
@@ -48,56 +72,43 @@ class PingResultParser(ResultParser):
 					"Found inconsistent peer_id: {}, expected: {}".format(
 						peer_id, self._peer_id)
 				)
-			# NOTE this is done because the sequence is stored as a string
-			# representation of a list, should be changed in the future so that
-			# it's a list from the start
-			import ast
-			delay_sequence = ast.literal_eval(entry[columns.index('delays')])
+			delay_sequence = decode_delays(delays_of(entry))
 
-			landmark = entry[columns.index('landmark')]
-			target_id = entry[columns.index('target_id')]
+			landmark = landmark_of(entry)
+			target_id = target_id_of(entry)
 
 			target = {}
 
 			if landmark is None and target_id is not None:
 				target['type'] = 'peer'
-				target['ip'] = entry[columns.index('destination_address')]
-				target['uuid'] = entry[columns.index('target_id')]
+				target['ip'] = address_of(entry)
+				target['uuid'] = target_id
 				target['port'] = '80' # TODO not in data
 			elif landmark is not None:
 				target['type'] = 'landmark'
-				target['ip'] = entry[columns.index('destination_address')]
-				target['domain'] = entry[columns.index('landmark')]
+				target['ip'] = address_of(entry)
+				target['domain'] = landmark
 				target['port'] = '80' # TODO not in data
 
 			db_entry = {
 				'task_name':'ping',
-				'start_time':entry[columns.index('start_time')],
-				'end_time':entry[columns.index('end_time')],
+				'start_time':start_time_of(entry),
+				'end_time':end_time_of(entry),
 				'target': target,
 				'value': {
 					# This is where the actual results go
 					'delay_sequence':delay_sequence,
-					'probe_count':entry[columns.index('ping_count')],
-					'packet_loss':entry[columns.index('packet_loss')],
-					'packet_size':entry[columns.index('packet_size')],
-					'max_rtt':entry[columns.index('maximum_RTT')],
-					'min_rtt':entry[columns.index('minimum_RTT')],
-					'avg_rtt':entry[columns.index('average_RTT')],
-					'stddev_rtt':entry[columns.index('stddev_RTT')],
+					'probe_count':ping_count_of(entry),
+					'packet_loss':packet_loss_of(entry),
+					'packet_size':packet_size_of(entry),
+					'max_rtt':max_rtt_of(entry),
+					'min_rtt':min_rtt_of(entry),
+					'avg_rtt':avg_rtt_of(entry),
+					'stddev_rtt':stddev_rtt_of(entry),
 				},
 			}
 
-			r = Result.fromDict(db_entry)
-			result_objects.append(r)
-			#from pprint import pformat
-			#self.log.info(pformat(r.toDict()))
-
-		self._result_objects = result_objects
-
-		self._parsed = True
-
-		return result_objects
+			yield Result.fromDict(db_entry)
 
 	def get_peer_id(self):
 		return self._peer_id
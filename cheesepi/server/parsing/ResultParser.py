@@ -1,13 +1,25 @@
 from __future__ import unicode_literals, absolute_import, print_function
 
 import json
+from decimal import Decimal
+from itertools import izip
 
+from cheesepi import codec
 from cheesepi.exceptions import UnsupportedResultType
 
+# Optional incremental JSON decoder (preferably its C backend), without it
+# result files are decoded whole into memory
+try:
+	import ijson.backends.yajl2_c as ijson
+except ImportError:
+	try:
+		import ijson
+	except ImportError:
+		ijson = None
+
 class ResultParser(object):
 
 	def __enter__(self):
-		self.parse()
 		return self
 
 	def __exit__(self, exc_type, exc_value, traceback):
@@ -15,19 +27,69 @@ class ResultParser(object):
 
 	@classmethod
 	def fromFile(cls, filename):
-		with open(filename) as fd:
-			json_obj = json.load(fd)
-		return cls.fromJson(json_obj)
+		with open(filename, 'rb') as fd:
+			return cls.fromFileobj(fd)
+
+	@classmethod
+	def fromFileobj(cls, fd):
+		"""
+		Parser for the results in the open file fd, either a column
+		oriented series (see cheesepi.codec) or JSON. With ijson installed
+		JSON rows are decoded lazily while the results are iterated, so fd
+		must stay open (and be seekable) until then.
+		"""
+		prefix = fd.read(len(codec.COLUMNS_MAGIC))
+		fd.seek(0)
+		if codec.is_columns(prefix):
+			name, columns, values = codec.read_columns(fd)
+			return cls.fromColumns(name, columns, izip(*values))
+
+		if ijson is None:
+			return cls.fromJson(json.load(fd))
+
+		name, columns = cls.read_header(fd)
+		fd.seek(0)
+		rows = (decode_numbers(row) for row in
+			ijson.items(fd, 'item.series.item.values.item'))
+		return cls.fromColumns(name, columns, rows)
 
 	@classmethod
 	def fromJson(cls, json_obj):
-		from .PingResultParser import PingResultParser
+		series = json_obj[0]['series'][0]
+		return cls.fromColumns(series['name'], series['columns'],
+			series.get('values', []))
 
-		name = cls.get_taskname(json_obj)
+	@classmethod
+	def fromColumns(cls, name, columns, rows):
+		from .PingResultParser import PingResultParser
 
-		if name == 'ping': return PingResultParser(json_obj)
+		if name == 'ping': return PingResultParser(columns, rows)
 		else: raise UnsupportedResultType("Unknown task type '{}'.".format(name))
 
+	@staticmethod
+	def read_header(fd):
+		"""
+		The name and columns of the first series in fd. Reading stops as
+		soon as both are found, values are skipped over without being
+		built if they come first.
+		"""
+		name = None
+		columns = None
+		columns_done = False
+		for prefix, event, value in ijson.parse(fd):
+			if prefix == 'item.series.item.name':
+				name = value
+			elif prefix == 'item.series.item.columns':
+				if event == 'start_array':
+					columns = []
+				elif event == 'end_array':
+					columns_done = True
+			elif prefix == 'item.series.item.columns.item':
+				columns.append(value)
+			if name is not None and columns_done:
+				return name, columns
+		raise UnsupportedResultType("No series found.")
+
 	@staticmethod
 	def get_taskname(obj):
 		return obj[0]['series'][0]['name']
@@ -36,6 +98,10 @@ class ResultParser(object):
 		raise NotImplementedError(
 		        "Abstract method 'parse' not implemented")
 
+	def iter_results(self):
+		raise NotImplementedError(
+		        "Abstract method 'iter_results' not implemented")
+
 	def get_result_set():
 		raise NotImplementedError(
 		        "Abstract method 'get_result_set' not implemented")
@@ -43,3 +109,9 @@ class ResultParser(object):
 	def write_to_db(self):
 		raise NotImplementedError(
 		        "Abstract method 'write_to_db' not implemented")
+
+def decode_numbers(row):
+	"""
+	ijson decodes non-integer numbers as Decimal
+	"""
+	return [float(v) if isinstance(v, Decimal) else v for v in row]
@@ -3,9 +3,12 @@ from __future__ import unicode_literals, absolute_import, print_function
 import os
 import shutil
 import logging
+import threading
+from io import BytesIO
 
+from cheesepi import compression
 from cheesepi.server.parsing.ResultParser import ResultParser
-from cheesepi.exceptions import UnsupportedResultType
+from cheesepi.exceptions import UnsupportedResultType, UploadProcessingError
 from .utils import untar, md5_filehash
 
 class ResultDataProcessor(object):
@@ -14,32 +17,59 @@ class ResultDataProcessor(object):
 	"""
 	log = logging.getLogger("cheesepi.server.parsing.ResultDataProcessor")
 
-	def __init__(self, filepath):
+	# At most this many results are held before being stored
+	_BATCH_SIZE = 10000
+
+	# Archives are processed in several threads (see UploadQueue), a
+	# peer's statistics are read, updated and written by one at a time
+	_peer_locks = {} # peer_id -> threading.Lock
+	_peer_locks_lock = threading.Lock()
+
+	@classmethod
+	def _peer_lock(cls, peer_id):
+		with cls._peer_locks_lock:
+			if peer_id not in cls._peer_locks:
+				cls._peer_locks[peer_id] = threading.Lock()
+			return cls._peer_locks[peer_id]
+
+	def __init__(self, filepath, md5_hash=None, stream=True):
 		"""
 		Object which encapsulates the handling of a result dump received
 		by the server. Should be initialized with the absolute path to a
-		tar archive with the results.
+		tar archive with the results. If the MD5 of the archive is already
+		known (it is checked while uploading) it can be passed as
+		md5_hash, otherwise it is calculated. With stream the members of
+		the archive are parsed straight out of it, otherwise they are
+		extracted to disk first.
 		"""
 		self._extracted = False
+		self._stream = stream
 		self._filepath = filepath
 		self._path = os.path.dirname(filepath)
 
-		self._md5_hash = md5_filehash(filepath)
+		if md5_hash is None:
+			md5_hash = md5_filehash(filepath)
+		self._md5_hash = md5_hash
 		self._extract_path = os.path.join(self._path, self._md5_hash)
 
 	def __enter__(self):
 		"""
-		Extract archive.
+		Extract archive, unless streaming.
 		"""
-		self.extract()
+		if not self._stream:
+			self.extract()
 		return self
 
 	def __exit__(self, exc_type, exc_value, traceback):
 		"""
-		Cleanup extracted files and delete the original tar archive.
+		Cleanup extracted files and delete the original tar archive,
+		unless processing failed. The archive is then kept, so that it
+		can be processed again (see UploadQueue).
 		"""
-		self.delete_extracted()
-		self.delete()
+		if self._extracted:
+			self.delete_extracted()
+		if exc_type is None:
+			self.delete()
 
 	def get_hash(self):
 		return self._md5_hash
@@ -59,67 +89,153 @@ class ResultDataProcessor(object):
 		self._extracted = False
 
 	def process(self):
-		if not self._extracted:
-			raise Exception("Data not extracted.")
-
-		#self.log.info("Processing files in {}".format(self._extract_path))
-
+		"""
+		Parse every file of the archive and store the results. Results
+		are grouped by peer over the whole archive, so that each peer's
+		statistics are read and written once, unless there are more than
+		_BATCH_SIZE results pending. Archives that have been processed
+		before are skipped, as are results that have been stored before.
+		Raises UploadProcessingError if a file could not be parsed or a
+		peer's results could not be stored, after storing the rest.
+		"""
 		from cheesepi.server.storage.mongo import MongoDAO
-		from pprint import pformat
-
-		# Process every file in the extracted folder
-		files = [os.path.join(self._extract_path, f)
-				for f in os.listdir(self._extract_path)]
-		for filename in files:
-			try:
-				dao = MongoDAO('localhost', 27017)
-
-				#parser = ResultParser.fromFile(filename)
-				with ResultParser.fromFile(filename) as parser:
-					results = parser.parse()
-					#self.log.info("Results {}".format(results))
-					peer_id = parser.get_peer_id()
-					self.log.info("Peer id {}".format(peer_id))
-
-					stats = dao.get_stats_set_for_results(peer_id, results)
-					#self.log.info("Fetched old stats")
-					#self.log.info("Fetched:\n{}".format(pformat(stats.toDict())))
-
-					upload_count = dao.get_result_count(peer_id)
-					stats.absorb_results(results, upload_index=upload_count+1)
-					#self.log.info("\n\nRESULT COUNT = {} for peer {}\n\n".format(result_count, peer_id))
-					#self.log.info("Absorbed new results")
-					#self.log.info("Absorbed:\n{}".format(pformat(stats.toDict())))
-
-					bulk_writer = dao.get_bulk_writer()
-
-					bulk_writer = dao.bulk_write_stats_set(bulk_writer, peer_id, stats)
 
-					# Write results
-					bulk_writer = dao.bulk_write_results(bulk_writer, peer_id, results)
+		dao = MongoDAO.shared('localhost', 27017)
 
-					res = bulk_writer.execute()
-					self.log.info("Bulk wrote to database with result: {}".format(res))
-
-					#parser.write_to_db()
-
-					#for result in results:
-						#res = dao.write_result(peer_id, result)
-						#self.log.info(res)
-
-				#from pprint import PrettyPrinter
-				#printer = PrettyPrinter(indent=2)
-				#printer.pprint(output)
+		if dao.is_upload_processed(self._md5_hash):
+			# The same archive again, e.g. the response to its upload was lost
+			self.log.info("Skipping already processed upload {}".format(self._md5_hash))
+			return
 
+		pending = {} # peer_id -> list of Result objects
+		pending_count = 0
+		stored = True
+		failed_files = []
+		for filename, fd in self.iter_files():
+			try:
+				with ResultParser.fromFileobj(fd) as parser:
+					# Results are decoded lazily
+					for result in parser.iter_results():
+						peer_id = parser.get_peer_id()
+						pending.setdefault(peer_id, []).append(result)
+						pending_count = pending_count + 1
+						if pending_count >= self._BATCH_SIZE:
+							stored = self.store_results(dao, pending) and stored
+							pending = {}
+							pending_count = 0
 			except UnsupportedResultType as e:
 				# TODO This suppresses the full stack trace for the moment, but
 				# should be removed once all parsers have been implemented. This
 				# is here to declutter the log while developing
 				self.log.warn("{}".format(e))
-			except Exception as e:
+			except Exception:
 				self.log.exception("Error parsing file {}".format(filename))
+				failed_files.append(filename)
 			finally:
-				dao.close()
+				fd.close()
+		stored = self.store_results(dao, pending) and stored
+
+		if len(failed_files) > 0:
+			raise UploadProcessingError("Could not parse {} of upload {}".format(
+				", ".join(failed_files), self._md5_hash))
+		if not stored:
+			raise UploadProcessingError("Could not store the results of upload {}".format(
+				self._md5_hash))
+		dao.set_upload_processed(self._md5_hash)
+
+	def iter_files(self):
+		"""
+		Yields (filename, open file) for every file of the archive.
+		"""
+		if self._stream:
+			# Parse every file member straight out of the archive, whatever
+			# it was compressed with
+			with compression.open_tar(self._filepath) as (tar, random_access):
+				for member in tar:
+					if not member.isfile():
+						continue
+					fd = tar.extractfile(member)
+					if not random_access:
+						# The parser seeks back after reading the header,
+						# members are single chunks so this is not much
+						fd = BytesIO(fd.read())
+					yield member.name, fd
+			return
+
+		if not self._extracted:
+			raise Exception("Data not extracted.")
+
+		#self.log.info("Processing files in {}".format(self._extract_path))
+
+		# Process every file in the extracted folder
+		files = [os.path.join(self._extract_path, f)
+				for f in os.listdir(self._extract_path)]
+		for filename in files:
+			yield filename, open(filename)
+
+	def store_results(self, dao, results_by_peer):
+		"""
+		Absorb each peer's results into its statistics, with one read and
+		one bulk write of the statistics and one of the results per peer.
+		Returns whether the results of every peer were stored.
+		"""
+		stored = True
+		for peer_id, results in results_by_peer.items():
+			# Otherwise an archive of the same peer processed at the same
+			# time could overwrite the statistics absorbed here
+			with self._peer_lock(peer_id):
+				stored = self._store_peer_results(dao, peer_id, results) and stored
+		return stored
+
+	def _store_peer_results(self, dao, peer_id, results):
+		from pprint import pformat
+
+		claimed = []
+		written = False
+		try:
+			self.log.info("Peer id {}".format(peer_id))
+			# Results that were uploaded again must not be counted twice
+			claimed = results = dao.claim_results(peer_id, results)
+			if len(results) == 0:
+				return True
+
+			stats, upload_count = dao.get_stats_set_and_count_for_results(
+				peer_id, results)
+			#self.log.info("Fetched:\n{}".format(pformat(stats.toDict())))
+
+			stats.absorb_results(results, upload_index=upload_count+1)
+			#self.log.info("Absorbed:\n{}".format(pformat(stats.toDict())))
+
+			# Write results to their buckets first, the statistics then
+			# never count results that were not stored
+			bulk_writer = dao.get_results_bulk_writer()
+			bulk_writer = dao.bulk_write_results(bulk_writer, peer_id, results)
+			bulk_writer.execute()
+			written = True
+			dao.confirm_results(peer_id, results)
+
+			bulk_writer = dao.get_bulk_writer()
+
+			bulk_writer = dao.bulk_write_stats_set(bulk_writer, peer_id, stats)
+			bulk_writer = dao.bulk_count_upload(bulk_writer, peer_id)
+
+			res = bulk_writer.execute()
+			self.log.info("Bulk wrote to database with result: {}".format(res))
+			return True
+		except Exception:
+			self.log.exception("Error storing results of peer {}".format(peer_id))
+			if written:
+				# They are in their buckets, releasing them would store them
+				# twice when uploaded again. The statistics miss them though
+				self.log.error("Statistics of peer {} miss {} stored results".format(
+					peer_id, len(claimed)))
+				return False
+			try:
+				# So that they are stored if they are uploaded again
+				dao.release_results(peer_id, claimed)
+			except Exception:
+				self.log.exception("Error releasing results of peer {}".format(peer_id))
+			return False
 
 	def delete(self):
 		"""
@@ -0,0 +1,123 @@
+from __future__ import unicode_literals, absolute_import, print_function
+
+import os
+import time
+import logging
+
+from twisted.internet import defer, threads
+from twisted.python import failure
+
+class UploadQueue(object):
+	"""
+	Processes uploaded archives in worker threads, so that the reactor
+	thread only has to receive them. The queue is a directory: an archive
+	stays in it until it has been processed, so uploads that were received
+	but not processed before a restart are processed after it.
+	"""
+	log = logging.getLogger("cheesepi.server.processing.UploadQueue")
+
+	def __init__(self, path, workers=4):
+		"""
+		Archives are queued in the directory path and at most workers of
+		them are processed at the same time. Archives that fail to be
+		processed are moved to path/failed.
+		"""
+		self._path = path
+		self._failed_path = os.path.join(path, "failed")
+		self._semaphore = defer.DeferredSemaphore(workers)
+
+		# Statistics, only updated from the reactor thread
+		self._queued = {} # filename -> time it was queued
+		self._hashes = {} # filename -> MD5, when known
+		self._processing = 0
+		self._processed = 0
+		self._failed = 0
+		self._total_latency = 0.0
+		self._total_processing_time = 0.0
+		self._last_latency = None
+
+		if not os.path.exists(self._failed_path):
+			os.makedirs(self._failed_path)
+
+	def get_path(self):
+		return self._path
+
+	def recover(self):
+		"""
+		Queue the archives left in the queue directory, oldest first.
+		"""
+		filenames = [os.path.join(self._path, f) for f in os.listdir(self._path)]
+		filenames = [f for f in filenames if os.path.isfile(f)]
+		filenames.sort(key=os.path.getmtime)
+		for filename in filenames:
+			self.log.info("Recovered queued upload {}".format(filename))
+			self._enqueue(filename, os.path.getmtime(filename))
+		return len(filenames)
+
+	def put(self, filename, md5_hash=None):
+		"""
+		Move a completely received archive into the queue. Returns a
+		Deferred which fires when it has been processed. Passing the
+		MD5 of the archive saves reading it again to calculate it.
+		"""
+		queued_filename = os.path.join(self._path, os.path.basename(filename))
+		if filename != queued_filename:
+			os.rename(filename, queued_filename)
+		if md5_hash is not None:
+			self._hashes[queued_filename] = md5_hash
+		return self._enqueue(queued_filename, time.time())
+
+	def _enqueue(self, filename, queued_at):
+		self._queued[filename] = queued_at
+		d = self._semaphore.run(self._start, filename)
+		d.addErrback(self._log_failure, filename)
+		return d
+
+	def _start(self, filename):
+		from cheesepi.server.processing.utils import process_upload
+
+		queued_at = self._queued.pop(filename)
+		self._processing += 1
+		d = threads.deferToThread(process_upload, filename,
+			self._hashes.pop(filename, None))
+		d.addBoth(self._done, filename, queued_at, time.time())
+		return d
+
+	def _done(self, result, filename, queued_at, started):
+		now = time.time()
+		self._processing -= 1
+		self._total_processing_time += now - started
+		self._last_latency = now - queued_at
+		self._total_latency += self._last_latency
+		if isinstance(result, failure.Failure):
+			self._failed += 1
+			# Keep it out of the queue, but do not lose it
+			if os.path.exists(filename):
+				os.rename(filename, os.path.join(self._failed_path,
+					os.path.basename(filename)))
+		else:
+			self._processed += 1
+		return result
+
+	def _log_failure(self, reason, filename):
+		self.log.error("Processing {} failed: {}".format(
+			filename, reason.getTraceback()))
+
+	def get_stats(self):
+		"""
+		Queue depth and processing latency, for monitoring.
+		"""
+		now = time.time()
+		done = self._processed + self._failed
+		return {
+			'queued': len(self._queued),
+			'processing': self._processing,
+			'processed': self._processed,
+			'failed': self._failed,
+			'oldest_queued_age': (now - min(self._queued.values())
+				if self._queued else 0),
+			'mean_processing_time': (self._total_processing_time / done
+				if done else None),
+			'mean_latency': self._total_latency / done if done else None,
+			'last_latency': self._last_latency,
+		}
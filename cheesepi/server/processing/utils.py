@@ -2,34 +2,53 @@ from __future__ import unicode_literals, absolute_import, print_function
 
 import logging
 import math
-import tarfile
 import hashlib
 
+from cheesepi import compression
+
+# Optional, DistributionModel updates large batches of samples with
+# vectorised operations if it is installed
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 # Processing functions, untar, calculating stats etc...
 # TODO some kind of logging??
 # How do we know where the database is???
 
-def process_upload(uploaded_file):
+def process_upload(uploaded_file, md5_hash=None):
 	from .ResultDataProcessor import ResultDataProcessor
 
-	with ResultDataProcessor(uploaded_file) as data:
+	with ResultDataProcessor(uploaded_file, md5_hash) as data:
 		data.process()
 
 	return True
 
 # TODO Maybe this should be baked into ResultDataProcessor
 def untar(filename, destination):
-	with tarfile.open(filename) as tar:
+	# Any of the upload compression codecs
+	with compression.open_tar(filename) as (tar, random_access):
 		tar.extractall(destination)
 
 def md5_filehash(filepath):
 	hasher = hashlib.md5()
-	with open(filepath) as fd:
-		hasher.update(fd.read())
+	with open(filepath, 'rb') as fd:
+		for block in iter(lambda: fd.read(65536), b""):
+			hasher.update(block)
 	return hasher.hexdigest()
 
 # This might be better to include from a well maintained library
 def median(input_list):
+	if numpy is not None and len(input_list) >= DistributionModel._VECTORISE_SIZE:
+		# Partially sorts, only as far as the middle
+		arr = numpy.asarray(input_list, dtype=float)
+		middle = len(arr) // 2
+		if len(arr) % 2 == 1:
+			return float(numpy.partition(arr, middle)[middle])
+		part = numpy.partition(arr, [middle - 1, middle])
+		return float(part[middle - 1] + part[middle]) / 2.0
+
 	lst = sorted(input_list)
 	if len(lst) < 1:
 		return 0
@@ -38,6 +57,41 @@ def median(input_list):
 	else:
 		return float(sum(lst[(len(lst)/2)-1:(len(lst)/2)+1]))/2.0
 
+def positive_samples_and_medians(sequences):
+	"""
+	Takes a list of sequences of samples (numpy required) and drops the
+	samples that are not positive (lost probes). Returns an array of the
+	remaining samples, in order, and an array of the median of each
+	sequence's remaining samples (0 for a sequence with none), as
+	median() would give for each of them.
+	"""
+	lengths = numpy.fromiter((len(seq) for seq in sequences), dtype=int,
+	                         count=len(sequences))
+	flat = numpy.fromiter((x for seq in sequences for x in seq), dtype=float,
+	                      count=int(lengths.sum()))
+	positive = flat > 0
+
+	# One row per sequence, padded and with the dropped samples replaced
+	# by inf so that selecting moves them to the end
+	width = max(int(lengths.max()), 1) if len(sequences) > 0 else 1
+	rows = numpy.repeat(numpy.arange(len(sequences)), lengths)
+	starts = numpy.cumsum(lengths) - lengths
+	columns = numpy.arange(len(flat)) - numpy.repeat(starts, lengths)
+	matrix = numpy.full((len(sequences), width), numpy.inf)
+	matrix[rows, columns] = numpy.where(positive, flat, numpy.inf)
+
+	# The middle one or two of each row's count positive samples. Rows
+	# with the same count are partitioned together, there are few counts
+	counts = numpy.bincount(rows[positive], minlength=len(sequences))
+	medians = numpy.zeros(len(sequences))
+	for count in numpy.unique(counts[counts > 0]):
+		selected = counts == count
+		low, high = (count - 1) // 2, count // 2
+		part = numpy.partition(matrix[selected], numpy.unique([low, high]), axis=1)
+		medians[selected] = (part[:, low] + part[:, high]) / 2.0
+
+	return flat[positive], medians
+
 class DistributionModel(object):
 	"""
 	TODO implement incremental calculation of skewness and kurtosis
@@ -45,9 +99,16 @@ class DistributionModel(object):
 	Keeps track of mean value, variance and standard deviation incrementally
 	while new data is supplied.
 	"""
+	__slots__ = ('_alpha', '_n', '_uni_mean', '_uni_variance', '_m2',
+	             '_exp_mean', '_exp_variance')
+
 	log = logging.getLogger("cheesepi.server.processing.DistributionModel")
 
 	_DEFAULT_ALPHA = 0.001
+	# Batches smaller than this are cheaper to loop over than to convert
+	_VECTORISE_SIZE = 32
+	# Largest factor the exponential weights of a block may grow by
+	_MAX_BLOCK_WEIGHT = 1e100
 
 	@classmethod
 	def fromDict(cls, dct):
@@ -189,8 +250,16 @@ class DistributionModel(object):
 
 	def add_data_uniform(self, samples, upload_index):
 
-		if not isinstance(samples, list):
-			samples = [samples]
+		samples = self._as_sequence(samples)
+		if len(samples) == 0:
+			return
+
+		if numpy is not None and len(samples) >= self._VECTORISE_SIZE:
+			x = numpy.asarray(samples, dtype=float)
+			batch_mean = float(x.mean())
+			batch_m2 = float(numpy.square(x - batch_mean).sum())
+			self._combine_uniform(len(samples), batch_mean, batch_m2)
+			return
 
 		n = self._n
 		mean = float(self._uni_mean)
@@ -207,25 +276,106 @@ class DistributionModel(object):
 		self._uni_mean = mean
 		self._uni_variance = m2 / max((n - 1), 1)
 
+	def _combine_uniform(self, n_b, mean_b, m2_b):
+		"""
+		Combine the count, mean and M2 of another set of samples with
+		ours (Chan et al's parallel algorithm).
+		"""
+		n_a = self._n
+		n = n_a + n_b
+		if n == 0:
+			return
+		delta = mean_b - self._uni_mean
+
+		self._uni_mean = self._uni_mean + delta * n_b / float(n)
+		self._m2 = self._m2 + m2_b + delta * delta * n_a * n_b / float(n)
+		self._n = n
+		self._uni_variance = self._m2 / max((n - 1), 1)
+
 	def add_data_exponential(self, samples, upload_index):
 
-		if not isinstance(samples, list):
-			samples = [samples]
+		samples = self._as_sequence(samples)
 
 		alpha = self._alpha
 		mean = self._exp_mean
 		variance = self._exp_variance
 
-		for x in samples:
-			delta = x - mean
-			increment = alpha * delta
-
-			mean = mean + increment
-			variance = (1-alpha) * (variance + (delta * increment))
+		if (numpy is not None and len(samples) >= self._VECTORISE_SIZE
+		    and 0 < alpha < 1):
+			x = numpy.asarray(samples, dtype=float)
+			beta = 1.0 - alpha
+			# The weights of a block grow as beta**-i, keep them finite
+			block = int(math.log(self._MAX_BLOCK_WEIGHT) / -math.log(beta))
+			block = max(1, min(block, 65536))
+			for start in range(0, len(x), block):
+				mean, variance = self._exponential_block(
+					x[start:start+block], mean, variance, beta)
+		else:
+			for x in samples:
+				delta = x - mean
+				increment = alpha * delta
+
+				mean = mean + increment
+				variance = (1-alpha) * (variance + (delta * increment))
 
 		self._exp_mean = mean
 		self._exp_variance = variance
 
+	def _exponential_block(self, x, mean, variance, beta):
+		"""
+		The same recursion as the loop in add_data_exponential, for an
+		array of samples at once. With alpha = 1 - beta, after sample i
+
+			mean_i = beta**i * (mean_0 + alpha * sum(beta**-j * x_j, j <= i))
+			variance_L = beta**L * variance_0
+			             + alpha * sum(beta**(L-i+1) * (x_i - mean_(i-1))**2)
+		"""
+		alpha = 1.0 - beta
+		length = len(x)
+		powers = beta ** numpy.arange(1, length + 1) # beta**i
+
+		means = powers * (mean + alpha * numpy.cumsum(x / powers))
+		previous = numpy.empty(length)
+		previous[0] = mean
+		previous[1:] = means[:-1]
+		deltas = x - previous
+
+		variance = (powers[-1] * variance
+		            + alpha * float(numpy.dot(powers[::-1], deltas * deltas)))
+		return float(means[-1]), variance
+
+	def _as_sequence(self, samples):
+		if isinstance(samples, (int, long, float)):
+			return [samples]
+		return samples
+
+	def merge(self, other):
+		"""
+		Add the samples other has absorbed as if they had been added to
+		this model, after the ones it already has. The uniform statistics
+		merge exactly in any case, the exponential ones only if other
+		started out empty (as a model absorbing a shard of the samples
+		does) and both have the same alpha.
+		"""
+		if other._alpha != self._alpha:
+			raise ValueError("Can not merge models with different alpha.")
+
+		k = other._n
+		beta_k = (1.0 - self._alpha) ** k
+		mean_a = self._exp_mean
+		mean_b = other._exp_mean
+
+		# Other's recursion started from a mean of 0 rather than mean_a,
+		# which shifted its means by beta**i * mean_a and so its deltas
+		# (which sum to mean_b / alpha) by -beta**(i-1) * mean_a
+		self._exp_mean = beta_k * mean_a + mean_b
+		self._exp_variance = (beta_k * self._exp_variance
+		                      + other._exp_variance
+		                      - 2 * beta_k * mean_a * mean_b
+		                      + beta_k * (1 - beta_k) * mean_a * mean_a)
+
+		self._combine_uniform(other._n, other._uni_mean, other._m2)
+
 
 	# def old_add_data(self, samples, upload_index=0):
 	# 	"""
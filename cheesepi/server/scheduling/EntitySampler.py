@@ -0,0 +1,113 @@
+from __future__ import unicode_literals, absolute_import, print_function
+
+import os
+import time
+import random
+import logging
+import threading
+
+# How many seconds the in-memory entities are trusted before they are
+# reloaded, to pick up entities registered by other processes
+RELOAD_INTERVAL = 300
+
+class EntitySampler(object):
+	"""
+	Keeps the uuids of all entities in memory, so that drawing random
+	entities for a schedule does not scan the entities collection.
+	Entities registered through this process are added straight away,
+	the rest are picked up when the entities are reloaded.
+	"""
+
+	log = logging.getLogger("cheesepi.server.scheduling.EntitySampler")
+
+	# One sampler per process, see shared()
+	_shared = {}
+	_shared_lock = threading.Lock()
+
+	@classmethod
+	def shared(cls, dao):
+		"""
+		Returns the sampler shared by every scheduler of this process.
+		"""
+		key = os.getpid()
+		with cls._shared_lock:
+			if key not in cls._shared:
+				cls._shared[key] = cls(dao)
+			return cls._shared[key]
+
+	def __init__(self, dao, reload_interval=RELOAD_INTERVAL):
+		self._dao = dao
+		self._reload_interval = reload_interval
+		self._lock = threading.Lock()
+		self._uuids = [] # for drawing a random index
+		self._entities = {} # uuid -> Entity object
+		self._loaded_at = None
+
+	def reload(self):
+		"""
+		Replace the entities with the ones in the database.
+		"""
+		entities = {}
+		for entity in self._dao.get_entities():
+			entities[entity.get_uuid()] = entity
+
+		with self._lock:
+			self._entities = entities
+			self._uuids = list(entities.keys())
+			self._loaded_at = time.time()
+		self.log.info("Loaded {} entities".format(len(entities)))
+
+	def _ensure_loaded(self):
+		if (self._loaded_at is None or
+		    time.time() - self._loaded_at > self._reload_interval):
+			self.reload()
+
+	def add(self, entity):
+		"""
+		Add (or update) an entity, call when one is registered.
+		"""
+		entity_uuid = entity.get_uuid()
+		with self._lock:
+			if entity_uuid not in self._entities:
+				self._uuids.append(entity_uuid)
+			self._entities[entity_uuid] = entity
+
+	def __len__(self):
+		self._ensure_loaded()
+		return len(self._uuids)
+
+	def sample(self, num, ignore_uuids=None):
+		"""
+		Returns a list of up to num distinct random entities, none of
+		them in ignore_uuids. Fewer are returned only when there are not
+		enough entities to choose from.
+		"""
+		self._ensure_loaded()
+		ignore = set(ignore_uuids or ())
+
+		with self._lock:
+			uuids = self._uuids
+			entities = self._entities
+
+			available = len(uuids) - len([u for u in ignore if u in entities])
+			num = min(num, available)
+			if num <= 0:
+				return []
+
+			if 2 * num < available:
+				# Most draws hit an entity that can be chosen, so this
+				# takes about num draws however many entities there are
+				chosen = []
+				chosen_set = set()
+				while len(chosen) < num:
+					entity_uuid = uuids[random.randrange(len(uuids))]
+					if entity_uuid in ignore or entity_uuid in chosen_set:
+						continue
+					chosen.append(entity_uuid)
+					chosen_set.add(entity_uuid)
+			else:
+				# Most of the entities are wanted, draw from those left
+				candidates = [u for u in uuids if u not in ignore]
+				chosen = random.sample(candidates, num)
+
+			return [entities[u] for u in chosen]
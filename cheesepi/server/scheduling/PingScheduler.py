@@ -1,20 +1,58 @@
 from __future__ import unicode_literals, absolute_import, print_function
 
+import time
 import logging
 import heapq
 import random
 
 from cheesepi.server.storage.mongo import MongoDAO
+from cheesepi.server.storage.models.entity import Entity
 from .Scheduler import Scheduler
+from .EntitySampler import EntitySampler
+from .PriorityCache import PriorityCache
 
 BLIND_SCHEDULE_RATIO=float(1)/float(3)
 
+# Priority functions take a target's priority summary (see
+# Statistics.toPriorityDict) and the current time, targets with the
+# highest priority are scheduled first
+
+def variance_priority(summary, now):
+	"""Targets whose delay varies the most"""
+	return summary['delay_variance']
+
+def staleness_priority(summary, now):
+	"""Targets measured the longest time ago"""
+	return now - summary.get('updated', 0)
+
+def uncertainty_priority(summary, now):
+	"""Targets whose mean delay is least certain, the variance of the
+	mean shrinks with the number of probes"""
+	return summary['delay_variance'] / max(summary['probe_count'], 1)
+
+PRIORITY_FUNCTIONS = {
+	'variance': variance_priority,
+	'staleness': staleness_priority,
+	'uncertainty': uncertainty_priority,
+}
+
 class PingScheduler(Scheduler):
 
 	log = logging.getLogger("cheesepi.server.scheduling.PingScheduler")
 
-	def __init__(self, uuid):
-		self.dao = MongoDAO('localhost', 27017)
+	def __init__(self, uuid, dao=None, sampler=None, priorities=None,
+	             priority='variance', blind_ratio=BLIND_SCHEDULE_RATIO):
+		if dao is None:
+			dao = MongoDAO.shared('localhost', 27017)
+		if sampler is None:
+			sampler = EntitySampler.shared(dao)
+		if priorities is None:
+			priorities = PriorityCache.shared(dao)
+		self.dao = dao
+		self.sampler = sampler
+		self.priorities = priorities
+		self.priority_function = PRIORITY_FUNCTIONS[priority]
+		self.blind_ratio = blind_ratio
 		self._uuid = uuid
 
 	def get_random_schedule(self, num=1, ignore_uuids=None):
@@ -22,22 +60,14 @@ class PingScheduler(Scheduler):
 		Get a random schedule, does not include self and does not allow for
 		duplicates.
 		"""
-		schedule = []
-
 		if ignore_uuids is None:
 			ignore_uuids = [self._uuid]
 		else:
 			ignore_uuids.append(self._uuid)
 
-		for i in range(0, num):
-			entity = self.dao.get_random_entity(ignore_uuids=ignore_uuids)
-
-			if entity is None:
-				# We've reached the limit of entities available for scheduling
-				break
-
-			schedule.append(entity)
-			ignore_uuids.append(entity.get_uuid())
+		# Drawn from memory in one go, rather than one query per entity
+		schedule = self.sampler.sample(num, ignore_uuids=ignore_uuids)
+		ignore_uuids.extend(entity.get_uuid() for entity in schedule)
 
 		return schedule
 
@@ -63,51 +93,37 @@ class PingScheduler(Scheduler):
 		# num is 1, we randomize if it will be random or not to achieve full coverage
 		if num == 1:
 			x = random.uniform(0.0, 1.0)
-			if x <= BLIND_SCHEDULE_RATIO:
+			if x <= self.blind_ratio:
 				non_blind_num = 0
 			else:
 				non_blind_num = 1
 		else:
-			non_blind_num = int(num - (num*BLIND_SCHEDULE_RATIO))
+			non_blind_num = int(num - (num*self.blind_ratio))
 
 		blind_num = num - non_blind_num
 
 		#self.log.info("Non blinds = {}".format(non_blind_num))
 
 		schedule = []
-		stats = self.dao.get_all_stats(self._uuid)
-		#self.log.info(pformat(stats.toDict()))
-
-		priority_sorted_targets = []
-
-		for s in stats:
-			target = s.get_target()
-			target_uuid = target.get_uuid()
+		# Compact per target summaries, not the full statistics
+		priorities = self.priorities.get(self._uuid)
 
-			if target_uuid not in ignore_uuids:
-				#print(pformat(s.toDict()))
-				delay = s.get_delay()
-				# self.log.info("\ndm1: {}\ndm2: {}\ndm3: {}\ndm4: {}\nsumdm: {}".format(
-				# 	delay._dm1, delay._dm2, delay._dm3, delay._dm4,
-				# 	delay._dm1 + delay._dm2 + delay._dm3 + delay._dm4)
-				# )
+		ignore = set(ignore_uuids)
+		candidates = (p for p in priorities
+		              if p['target']['uuid'] not in ignore)
 
-				delay_variance = delay.get_exp_variance()
-				#print(target)
-				#print(delay_variance)
+		# Only the non_blind_num best are needed, not all of them sorted
+		now = time.time()
+		priority_function = self.priority_function
+		best = heapq.nlargest(non_blind_num, candidates,
+		                      key=lambda p: priority_function(p, now))
 
-				# Primitive bias towards variance
-				heapq.heappush(priority_sorted_targets, (-delay_variance, target))
+		for p in best:
+			entity = Entity.fromDict(p['target'])
 
-		#print(priority_sorted_targets)
-
-		for i in range(0, min(non_blind_num,len(priority_sorted_targets))):
-			target = heapq.heappop(priority_sorted_targets)
-			target_uuid = target[1].get_uuid()
-
-			schedule.append(target[1])
+			schedule.append(entity)
 
-			ignore_uuids.append(target_uuid)
+			ignore_uuids.append(entity.get_uuid())
 
 		if len(schedule) < non_blind_num:
 			# schedule length needs to be filled with more blinds
@@ -0,0 +1,67 @@
+from __future__ import unicode_literals, absolute_import, print_function
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+# How many seconds a peer's priorities are used before they are read
+# again, results are absorbed by the upload server, not this process
+CACHE_TTL = 60
+# How many peers' priorities are kept, least recently used are dropped
+CACHE_SIZE = 10000
+
+class PriorityCache(object):
+	"""
+	Caches the target priority summaries of peers (see
+	MongoDAO.get_target_priorities), so that repeated schedule requests
+	from a peer do not query the database each time.
+	"""
+
+	log = logging.getLogger("cheesepi.server.scheduling.PriorityCache")
+
+	# One cache per process, see shared()
+	_shared = {}
+	_shared_lock = threading.Lock()
+
+	@classmethod
+	def shared(cls, dao):
+		"""
+		Returns the cache shared by every scheduler of this process.
+		"""
+		key = os.getpid()
+		with cls._shared_lock:
+			if key not in cls._shared:
+				cls._shared[key] = cls(dao)
+			return cls._shared[key]
+
+	def __init__(self, dao, ttl=CACHE_TTL, size=CACHE_SIZE):
+		self._dao = dao
+		self._ttl = ttl
+		self._size = size
+		self._lock = threading.Lock()
+		self._cache = OrderedDict() # uuid -> (time loaded, priorities)
+
+	def get(self, uuid):
+		"""
+		Returns the list of priority summaries of peer uuid's targets.
+		"""
+		now = time.time()
+		with self._lock:
+			entry = self._cache.pop(uuid, None)
+			if entry is not None and now - entry[0] <= self._ttl:
+				self._cache[uuid] = entry # most recently used
+				return entry[1]
+
+		priorities = self._dao.get_target_priorities(uuid)
+
+		with self._lock:
+			self._cache[uuid] = (now, priorities)
+			while len(self._cache) > self._size:
+				self._cache.popitem(last=False)
+		return priorities
+
+	def invalidate(self, uuid):
+		with self._lock:
+			self._cache.pop(uuid, None)
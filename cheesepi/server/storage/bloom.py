@@ -0,0 +1,50 @@
+from __future__ import unicode_literals, absolute_import, print_function
+
+import math
+import struct
+import logging
+
+class BloomFilter(object):
+	"""
+	A set of digests (of at least 16 bytes, e.g. MD5) that can answer
+	"definitely not added" or "probably added", in a fixed amount of
+	memory. Once more than capacity digests have been added it starts
+	over empty, rather than giving more and more false positives.
+	"""
+	log = logging.getLogger("cheesepi.server.storage.BloomFilter")
+
+	def __init__(self, capacity=1000000, error_rate=0.001):
+		self._capacity = capacity
+		# The optimal number of bits and hash functions for the error rate
+		self._bit_count = int(math.ceil(
+			-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+		self._hash_count = max(1, int(round(
+			float(self._bit_count) / capacity * math.log(2))))
+		self.clear()
+
+	def clear(self):
+		self._bits = bytearray((self._bit_count + 7) // 8)
+		self._count = 0
+
+	def _positions(self, digest):
+		# Double hashing, the digest is already uniformly distributed
+		h1, h2 = struct.unpack_from(str("<QQ"), digest)
+		for i in range(self._hash_count):
+			yield (h1 + i * h2) % self._bit_count
+
+	def add(self, digest):
+		if self._count >= self._capacity:
+			self.log.info("Bloom filter full, starting over")
+			self.clear()
+		for position in self._positions(digest):
+			self._bits[position >> 3] |= 1 << (position & 7)
+		self._count = self._count + 1
+
+	def __contains__(self, digest):
+		for position in self._positions(digest):
+			if not self._bits[position >> 3] & (1 << (position & 7)):
+				return False
+		return True
+
+	def __len__(self):
+		return self._count
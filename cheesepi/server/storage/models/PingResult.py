@@ -1,9 +1,15 @@
 from __future__ import unicode_literals, absolute_import
 
+from array import array
+
 from .result import Result
 from .entity import Entity
+from cheesepi.codec import decode_delays
 
 class PingResult(Result):
+	__slots__ = ('_start_time', '_end_time', '_target', '_delay_sequence',
+	             '_probe_count', '_packet_loss', '_packet_size', '_max_rtt',
+	             '_min_rtt', '_avg_rtt', '_stddev_rtt')
 
 	@classmethod
 	def fromDict(cls, dct):
@@ -14,11 +20,15 @@ class PingResult(Result):
 		p._end_time = dct['end_time']
 		p._target = Entity.fromDict(dct['target'])
 
-		seq = dct['value']['delay_sequence']
-		if isinstance(seq, str):
-		    import ast
-		    seq = ast.literal_eval(seq)
-		p._delay_sequence = seq
+		seq = decode_delays(dct['value']['delay_sequence'])
+		if isinstance(seq, array):
+			p._delay_sequence = seq
+		else:
+			try:
+				# Packed doubles take a fraction of a list of floats
+				p._delay_sequence = array(str('d'), seq)
+			except TypeError:
+				p._delay_sequence = seq
 
 		p._probe_count = dct['value']['probe_count']
 		p._packet_loss = dct['value']['packet_loss']
@@ -50,7 +60,8 @@ class PingResult(Result):
 			'end_time':self._end_time,
 			'target':self._target.toDict(),
 			'value':{
-				'delay_sequence':self._delay_sequence,
+				'delay_sequence':(list(self._delay_sequence)
+				                  if self._delay_sequence is not None else None),
 				'probe_count':self._probe_count,
 				'packet_loss':self._packet_loss,
 				'packet_size':self._packet_size,
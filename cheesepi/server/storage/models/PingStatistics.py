@@ -1,10 +1,14 @@
 from __future__ import unicode_literals, absolute_import
 
 from .statistics import Statistics
+from cheesepi.server.processing import utils
 from cheesepi.server.processing.utils import DistributionModel
 from cheesepi.server.storage.models.entity import Entity
 
 class PingStatistics(Statistics):
+	__slots__ = ('_target', '_delay', '_average_delay', '_average_median_delay',
+	             '_average_packet_loss', '_all_time_min_rtt', '_all_time_max_rtt',
+	             '_total_packet_loss', '_total_probe_count')
 
 	@classmethod
 	def fromDict(cls, dct):
@@ -46,6 +50,19 @@ class PingStatistics(Statistics):
 			'total_probe_count':self._total_probe_count,
 		}
 
+	def toPriorityDict(self):
+		"""
+		The few values schedulers prioritise targets by, stored next to
+		the statistics so that scheduling does not have to load them.
+		"""
+		return {
+			'task_name':'ping',
+			'target':self._target.toDict(),
+			'delay_mean':self._delay.get_exp_mean(),
+			'delay_variance':self._delay.get_exp_variance(),
+			'probe_count':self._total_probe_count,
+		}
+
 	def get_type(self):
 		return 'ping'
 
@@ -100,3 +117,35 @@ class PingStatistics(Statistics):
 		self._average_packet_loss.add_data(
 		        float(result.get_packet_loss())/float(result.get_probe_count()),
 		        upload_index=upload_index)
+
+	def absorb_results(self, result_list, upload_index=0):
+		"""
+		Same as absorb_result for every result in result_list, but with
+		each DistributionModel updated once, with all of the samples.
+		"""
+		if utils.numpy is None or len(result_list) < 2:
+			return super(PingStatistics, self).absorb_results(result_list,
+			                                                  upload_index=upload_index)
+
+		probe_counts = [r.get_probe_count() for r in result_list]
+		packet_losses = [r.get_packet_loss() for r in result_list]
+
+		self._total_probe_count = self._total_probe_count + sum(probe_counts)
+		self._total_packet_loss = self._total_packet_loss + sum(packet_losses)
+		self._all_time_min_rtt = min(self._all_time_min_rtt,
+		                             min(r.get_min_rtt() for r in result_list))
+		self._all_time_max_rtt = max(self._all_time_max_rtt,
+		                             max(r.get_max_rtt() for r in result_list))
+
+		sequences = [r.get_delay_sequence() for r in result_list]
+		average_delays = [r.get_avg_rtt() for r in result_list]
+		packet_loss_ratios = [float(loss)/float(count)
+		                      for loss, count in zip(packet_losses, probe_counts)]
+
+		# Lost packets are dropped, as in absorb_result
+		pure_samples, medians = utils.positive_samples_and_medians(sequences)
+
+		self._delay.add_data(pure_samples, upload_index=upload_index)
+		self._average_median_delay.add_data(medians, upload_index=upload_index)
+		self._average_delay.add_data(average_delays, upload_index=upload_index)
+		self._average_packet_loss.add_data(packet_loss_ratios, upload_index=upload_index)
@@ -5,19 +5,39 @@ import uuid
 
 from cheesepi.exceptions import UnsupportedEntityType
 
+# How many entities Entity.fromDict keeps for reuse
+ENTITY_CACHE_SIZE = 100000
+
 class Entity(object):
+	__slots__ = ()
 
 	log = logging.getLogger("cheesepi.server.storage.models.entity.Entity")
 
+	# Entities can not be changed, so every result and statistic with the
+	# same target can share one. Keyed by the uuid of peers and the domain
+	# of landmarks, which their uuid is derived from
+	_cache = {}
+
 	@classmethod
 	def fromDict(cls, dct):
-		from pprint import pformat
 		entity_type = dct['type']
 
-		if entity_type == 'landmark': return LandmarkEntity.fromDict(dct)
-		if entity_type == 'peer': return PeerEntity.fromDict(dct)
+		if entity_type == 'landmark': key = dct['domain']
+		elif entity_type == 'peer': key = dct['uuid']
 		else: raise UnsupportedEntityType("Unknown entity type '{}'.".format(entity_type))
 
+		entity = Entity._cache.get((entity_type, key))
+		if entity is not None and entity._ip == dct['ip']:
+			return entity
+
+		if entity_type == 'landmark': entity = LandmarkEntity.fromDict(dct)
+		else: entity = PeerEntity.fromDict(dct)
+
+		if len(Entity._cache) >= ENTITY_CACHE_SIZE:
+			Entity._cache.clear()
+		Entity._cache[(entity_type, key)] = entity
+		return entity
+
 	def toDict(self):
 		raise NotImplementedError("Abstract method 'toDict' not implemented.")
 
@@ -25,6 +45,7 @@ class Entity(object):
 		raise NotImplementedError("Abstract method 'get_uuid' not implemented.")
 
 class LandmarkEntity(Entity):
+	__slots__ = ('_ip', '_domain', '_uuid')
 
 	log = logging.getLogger("cheesepi.server.storage.models.entity.LandmarkEntity")
 
@@ -37,21 +58,22 @@ class LandmarkEntity(Entity):
 		self._ip = ip
 		#self._port = port
 		self._domain = domain
-		self._uuid = uuid.uuid5(uuid.NAMESPACE_DNS, domain)
+		self._uuid = str(uuid.uuid5(uuid.NAMESPACE_DNS, domain.encode('utf-8')))
 
 	def toDict(self):
 		return {
 			'type':'landmark',
 			'ip':self._ip,
 			'domain':self._domain,
-			'uuid':str(self._uuid),
+			'uuid':self._uuid,
 		}
 
 	def get_uuid(self):
-		return str(self._uuid)
+		return self._uuid
 
 
 class PeerEntity(Entity):
+	__slots__ = ('_ip', '_uuid')
 
 	log = logging.getLogger("cheesepi.server.storage.models.entity.PeerEntity")
 
@@ -63,15 +85,15 @@ class PeerEntity(Entity):
 	def __init__(self, ip, peer_uuid):
 		self._ip = ip
 		#self._port = port
-		self._uuid = uuid.UUID(peer_uuid)
-		assert peer_uuid == str(self._uuid)
+		self._uuid = str(uuid.UUID(peer_uuid))
+		assert peer_uuid == self._uuid
 
 	def toDict(self):
 		return {
 			'type':'peer',
 			'ip':self._ip,
-			'uuid':str(self._uuid),
+			'uuid':self._uuid,
 		}
 
 	def get_uuid(self):
-		return str(self._uuid)
+		return self._uuid
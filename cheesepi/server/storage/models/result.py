@@ -3,6 +3,7 @@ from __future__ import unicode_literals, absolute_import
 from cheesepi.exceptions import UnsupportedResultType
 
 class Result(object):
+	__slots__ = ()
 
 	@classmethod
 	def fromDict(cls, dct):
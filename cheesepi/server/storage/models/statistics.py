@@ -1,13 +1,14 @@
 from __future__ import unicode_literals, absolute_import
 
 import logging
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from cheesepi.server.storage.models.entity import Entity
 
 TargetStatistic = namedtuple("TargetStatistic", ["target", "stat_type"])
 
 class Statistics(object):
+	__slots__ = ()
 	log = logging.getLogger("cheesepi.server.storage.models.statistics.Statistics")
 
 	@classmethod
@@ -33,11 +34,27 @@ class Statistics(object):
 	def toDict(self):
 		raise NotImplementedError("Abstract method 'toDict' not implemented.")
 
+	def toPriorityDict(self):
+		raise NotImplementedError("Abstract method 'toPriorityDict' not implemented.")
+
+	def absorb_result(self, result, upload_index=0):
+		raise NotImplementedError("Abstract method 'absorb_result' not implemented.")
+
+	def absorb_results(self, result_list, upload_index=0):
+		"""
+		Absorb a list of results for this target, in order. Subclasses
+		can override this to absorb them all in one pass.
+		"""
+		for result in result_list:
+			self.absorb_result(result, upload_index=upload_index)
+
 class StatisticsSet(object):
 	"""
 	A StatisticsSet can contain a set of statistics that can come from different
 	tasks and for different targets.
 	"""
+	__slots__ = ('_statistics_set',)
+
 	log = logging.getLogger("cheesepi.server.storage.models.statistics.StatisticsSet")
 
 	@classmethod
@@ -96,8 +113,11 @@ class StatisticsSet(object):
 
 	def absorb_results(self, result_list, upload_index=0):
 		"""
-		Takes a list of results and updates all statistics objects accordingly
+		Takes a list of results and updates all statistics objects accordingly.
+		The results are grouped by target and task first, so that each
+		statistics object absorbs all of its results in one go.
 		"""
+		grouped = OrderedDict() # TargetStatistic -> list of results
 
 		for result in result_list:
 
@@ -111,4 +131,8 @@ class StatisticsSet(object):
 				self.log.info("TargetStat '{}' not present in set, inserting.".format(target_stat))
 				stat = Statistics.fromName(task_name, target)
 				self._statistics_set[target_stat] = stat
-			self._statistics_set[target_stat].absorb_result(result, upload_index=upload_index)
+			grouped.setdefault(target_stat, []).append(result)
+
+		for target_stat, results in grouped.items():
+			self._statistics_set[target_stat].absorb_results(results,
+			                                                  upload_index=upload_index)
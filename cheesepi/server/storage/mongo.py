@@ -1,11 +1,19 @@
+import os
 import time
+import hashlib
+import threading
+from datetime import datetime
 
 import logging
 import pymongo
 import math
+from bson.binary import Binary
+from pymongo.errors import BulkWriteError
 
 from .dao import DAO
 from cheesepi.exceptions import ServerDaoError, NoSuchPeer
+from cheesepi.codec import pack_delays
+from cheesepi.server.storage.bloom import BloomFilter
 
 from cheesepi.server.storage.models.statistics import StatisticsSet
 from cheesepi.server.storage.models.entity import Entity, PeerEntity, LandmarkEntity
@@ -13,25 +21,75 @@ from cheesepi.server.storage.models.entity import Entity, PeerEntity, LandmarkEn
 # What is the threshold in seconds to be considered 'active'
 ACTIVE_THRESHOLD = 3600
 
+# Raw results are stored in one bucket per (peer, target, day) and the
+# buckets are removed by mongo this many seconds after their day ends
+RESULT_BUCKET_SECONDS = 86400
+RESULT_RETENTION = 90 * 86400
+
+# Mongo's error code for a duplicate key
+DUPLICATE_KEY = 11000
+
 class MongoDAO(DAO):
 	log = logging.getLogger("cheesepi.server.storage.MongoDAO")
 
+	# One DAO per (host, port) and process, see shared()
+	_shared = {}
+	_shared_lock = threading.Lock()
+	# (host, port) whose indexes this process has already ensured
+	_indexed = set()
+
+	@classmethod
+	def shared(cls, host='localhost', port=27017):
+		"""
+		Returns the DAO shared by every thread of this process. Its
+		MongoClient is thread safe and pools its connections, so there is
+		no need for a DAO per file or request. Should not be closed.
+		"""
+		key = (host, port, os.getpid()) # clients do not survive a fork
+		with cls._shared_lock:
+			if key not in cls._shared:
+				cls._shared[key] = cls(host, port)
+			return cls._shared[key]
+
 	def __init__(self, host='localhost', port=27017):
-		self.client = pymongo.MongoClient()
+		self.client = pymongo.MongoClient(host, port)
 		self.db = self.client.cheesepi
+		# Keys of the results stored through this DAO, see claim_results.
+		# Only a hint, result_keys decides what is a duplicate
+		self._seen_results = BloomFilter()
 
-		# Initialization stuff
+		if (host, port) not in MongoDAO._indexed:
+			self.ensure_indexes()
+			MongoDAO._indexed.add((host, port))
+
+	def ensure_indexes(self):
+		"""
+		Create the indexes, should be called once at server start.
+		"""
 		# This makes sure that the uuid field is unique and fast lookups can
 		# be performed
 		self.db.beacons.create_index([("last_seen",pymongo.ASCENDING)])
 		self.db.tasks.create_index([("uuid",pymongo.ASCENDING)])
 		self.db.entities.create_index([("uuid",pymongo.ASCENDING)], unique=True)
 		self.db.peers.create_index([("uuid",pymongo.ASCENDING)], unique=True)
-		# This (I think) ensures fast lookups for ('uuid','results.target_id')
-		self.db.peers.create_index([("uuid",pymongo.ASCENDING),
-		                            ("results.target_id",pymongo.ASCENDING)])
 		self.db.peers.create_index([("uuid",pymongo.ASCENDING),
 		                            ("statistics.target_id",pymongo.ASCENDING)])
+		# One result bucket per peer, target and day, see bulk_write_results
+		self.db.results.create_index([("peer",pymongo.ASCENDING),
+		                              ("target",pymongo.ASCENDING),
+		                              ("day",pymongo.ASCENDING)], unique=True)
+		self.db.results.create_index([("peer",pymongo.ASCENDING),
+		                              ("day",pymongo.ASCENDING)])
+		# Buckets expire on their own, expireAfterSeconds=0 makes mongo
+		# delete them once their 'expires' date has passed
+		self.db.results.create_index([("expires",pymongo.ASCENDING)],
+		                             expireAfterSeconds=0)
+		# Keys of stored results and processed uploads (their _id), which
+		# are forgotten along with the results
+		self.db.result_keys.create_index([("expires",pymongo.ASCENDING)],
+		                                 expireAfterSeconds=0)
+		self.db.uploads.create_index([("expires",pymongo.ASCENDING)],
+		                             expireAfterSeconds=0)
 
 	def close(self):
 		self.client.close()
@@ -39,6 +97,9 @@ class MongoDAO(DAO):
 	def get_bulk_writer(self):
 		return self.db.peers.initialize_ordered_bulk_op()
 
+	def get_results_bulk_writer(self):
+		return self.db.results.initialize_unordered_bulk_op()
+
 	def peer_beacon(self, uuid, host, last_seen=0):
 		if last_seen==0: last_seen=time.time()
 		result = self.db.beacons.update_one(
@@ -92,47 +153,32 @@ class MongoDAO(DAO):
 		)
 		return self._return_status(result.acknowledged)
 
-	def get_random_entity(self, ignore_uuids=None):
-		import re
-		from random import randint
+	def get_entities(self):
+		"""
+		Yields every entity as an Entity object.
+		"""
+		for entity in self.db.entities.find({}, {'_id':0}):
+			yield Entity.fromDict(entity)
 
+	def get_random_entity(self, ignore_uuids=None):
+		"""
+		Returns a random entity not in ignore_uuids, None if there is
+		none. Schedulers should draw from an EntitySampler instead, this
+		still queries the database.
+		"""
 		if ignore_uuids is not None:
-			#ignore_regex = []
-			#for uuid in ignore_uuids:
-				#r = re.compile(uuid)
-				#ignore_regex.append(r)
-
 			query = {'uuid': { '$nin': ignore_uuids } }
 		else:
 			query = {}
 
-		#self.log.info("UUID: {}".format(ignore_uuid))
-		#self.log.info("Query: {}".format(query))
-		#num_entities = self.db.entities.count()
-		#self.log.info("{} entities in collection".format(num_entities))
-
-		cursor = self.db.entities.find(query)
-		if cursor.count() < 1:
-			# No entities available
-			return None
-
-		skipcount = randint(0, cursor.count()-1)
-		#self.log.info("skipcount: {}".format(skipcount))
-		cursor.skip(skipcount) # skip the first skipcount elements
-		cursor.limit(-1) # pick the last element
-
-		#self.log.info("{}".format(cursor))
-		#self.log.info("Cursor count: {}".format(cursor.count()))
-
-		if cursor.count() > 0 and cursor.alive:
-			#self.log.info("alive? {}".format(cursor.alive))
-			#self.log.info("\n{}".format(cursor.mystats()))
-			entity = cursor.next()
-			entity_obj = Entity.fromDict(entity)
-			return entity_obj
-		else:
-			# What does this mean????
-			raise ServerDaoError()
+		cursor = self.db.entities.aggregate([
+			{'$match': query},
+			{'$sample': {'size': 1}},
+		])
+		for entity in cursor:
+			return Entity.fromDict(entity)
+		# No entities available
+		return None
 
 	def get_sequential_entities(self, uuid, length=1):
 		"""
@@ -245,11 +291,28 @@ class MongoDAO(DAO):
 			A StatisticsSet object if query is successful, None
 			otherwise.
 		"""
+		stats_set, upload_count = self._find_stats(uuid, targets)
+		return stats_set
+
+	def get_stats_set_and_count_for_results(self, uuid, results):
+		"""
+		Same as get_stats_set_for_results and get_result_count, in a
+		single query.
+
+		Args:
+			uuid: a peer uuid
+			results: a list of Result objects
+		Returns:
+			A tuple of a StatisticsSet object and the number of uploads
+			received from the peer
+		"""
+		targets = [result.get_target() for result in results]
 
-		projection = None
+		return self._find_stats(uuid, targets, {'uploads_received':1})
 
+	def _find_stats(self, uuid, targets, projection=None):
 		if targets is not None:
-			projection = {}
+			projection = dict(projection or {})
 			for target in targets:
 				key = "statistics.{}".format(target.get_uuid())
 				projection[key] = 1
@@ -259,12 +322,50 @@ class MongoDAO(DAO):
 			projection,
 		)
 
+		upload_count = 0
+		if stats is not None and 'uploads_received' in stats:
+			upload_count = stats['uploads_received']
+
 		# Should be unique so can only ever find one
 		if stats is not None and 'statistics' in stats:
 			#self.log.info(stats[0])
-			return StatisticsSet.fromDict(stats['statistics'])
+			return StatisticsSet.fromDict(stats['statistics']), upload_count
 		else:
-			return StatisticsSet()
+			return StatisticsSet(), upload_count
+
+	def get_target_priorities(self, uuid, stat_type='ping'):
+		"""
+		Returns the priority summaries (see Statistics.toPriorityDict)
+		of the stat_type statistics of every target of peer uuid. Only
+		the summaries are loaded, not the statistics themselves.
+
+		Args:
+			uuid: a peer uuid
+			stat_type: the type of statistics
+		Returns:
+			A list of dicts
+		"""
+		peer = self.db.peers.find_one({'uuid':uuid}, {'priorities':1})
+		if peer is None:
+			return []
+
+		if 'priorities' not in peer:
+			has_stats = self.db.peers.find_one(
+				{'uuid':uuid, 'statistics':{'$exists':True}},
+				{'_id':1}
+			)
+			if has_stats is None:
+				return []
+			# Statistics written before the summaries were, build them
+			# once and store them for next time
+			self.log.info("Writing priority summaries of {}".format(uuid))
+			stats = self.get_all_stats(uuid)
+			self.write_stats_set(uuid, stats)
+			peer = self.db.peers.find_one({'uuid':uuid}, {'priorities':1})
+
+		return [by_type[stat_type]
+		        for by_type in peer.get('priorities', {}).values()
+		        if stat_type in by_type]
 
 	def write_stats_set(self, uuid, statistics_set):
 		"""
@@ -287,7 +388,9 @@ class MongoDAO(DAO):
 
 	def bulk_write_stats_set(self, bulk_writer, uuid, statistics_set):
 		"""
-		Queue writing of a StatisticsSet object to a bulk writer object.
+		Queue writing of a StatisticsSet object to a bulk writer object,
+		along with the priority summary of each statistic (see
+		get_target_priorities).
 
 		Args:
 			bulk_writer: a bulk writer object
@@ -299,6 +402,7 @@ class MongoDAO(DAO):
 		#self.log.info("IN WRITE_STATS")
 
 		prefix_key = "statistics" #.format(target.get_uuid())
+		now = time.time()
 
 		stat_object = {}
 		#self.log.info(statistics_set)
@@ -311,6 +415,10 @@ class MongoDAO(DAO):
 			#stat_object[stat_target_uuid][stat_type] = stat.toDict()
 
 			key = "{}.{}".format(prefix_key, stat_target_uuid)
+			priority_key = "priorities.{}.{}".format(stat_target_uuid,
+			                                         stat.get_type())
+			priority = stat.toPriorityDict()
+			priority['updated'] = now
 
 			bulk_writer.find(
 				{'uuid':uuid}
@@ -320,6 +428,7 @@ class MongoDAO(DAO):
 					key:{
 						stat.get_type():stat.toDict(),
 						},
+					priority_key:priority,
 					}
 				},
 			)
@@ -337,58 +446,311 @@ class MongoDAO(DAO):
 		Returns:
 			the result of the write operation
 		"""
-		bulk_writer = self.db.peers.initialize_ordered_bulk_op()
-
+		bulk_writer = self.get_results_bulk_writer()
 		bulk_writer = self.bulk_write_results(bulk_writer, uuid, results)
-
 		result = bulk_writer.execute()
+
+		bulk_writer = self.bulk_count_upload(self.get_bulk_writer(), uuid)
+		bulk_writer.execute()
+
 		self.log.info("Wrote a list of results objects with result: {}".format(result))
 		return result
 
-	def bulk_write_results(self, bulk_writer, uuid, results):
+	def bulk_count_upload(self, bulk_writer, uuid):
 		"""
-		Queue writing of a list of Result objects to a bulk writer
-		object.
+		Queue incrementing the number of uploads received from a peer to
+		a bulk writer object from get_bulk_writer().
 
 		Args:
 			bulk_writer: a bulk writer object
 			uuid: a peer uuid
-			results: a list of Result objects
 		Returns:
 			the modified bulk writer object
 		"""
 		bulk_writer.find(
 			{'uuid':uuid}
 			).upsert(
-			).update(
-			{'$inc': {'uploads_received': 1},
-			 '$push': {
-				'results':{
-					'$each': [r.toDict() for r in results]}
-				}
-			}
+			).update_one(
+			{'$inc': {'uploads_received': 1}}
 		)
 		return bulk_writer
 
-	def purge_results(self, uuid):
-		result = self.db.peers.update(
-			{'uuid':uuid},
-			{'results':[]}
+	def bulk_write_results(self, bulk_writer, uuid, results):
+		"""
+		Queue writing of a list of Result objects to a bulk writer
+		object from get_results_bulk_writer(). The results are appended
+		to the bucket of their peer, target and day, so that no document
+		grows without bound and old results expire a bucket at a time.
+
+		Args:
+			bulk_writer: a bulk writer object
+			uuid: a peer uuid
+			results: a list of Result objects
+		Returns:
+			the modified bulk writer object
+		"""
+		buckets = {} # (target uuid, day) -> list of result dicts
+		skipped = 0
+		for r in results:
+			if r.get_start_time() is None:
+				# Malformed, it has no day to be stored under
+				skipped = skipped + 1
+				continue
+			key = (r.get_target().get_uuid(), self._result_day(r.get_start_time()))
+			buckets.setdefault(key, []).append(
+				self._pack_result(r, self._result_key(uuid, r)))
+		if skipped > 0:
+			self.log.warn("Skipping {} results of {} without a start time".format(
+				skipped, uuid))
+
+		for (target_uuid, day), dicts in buckets.items():
+			bulk_writer.find(
+				{'peer':uuid, 'target':target_uuid, 'day':day}
+				).upsert(
+				).update_one(
+				{'$setOnInsert': {'expires':self._result_expiry(day)},
+				 '$inc': {'count': len(dicts)},
+				 '$push': {'results': {'$each': dicts}}
+				}
+			)
+		return bulk_writer
+
+	def _pack_result(self, result, key):
+		dct = result.toDict()
+		# Tells which claimed results were stored, see claim_results
+		dct['key'] = Binary(key)
+		value = dct.get('value', {})
+		if value.get('delay_sequence') is not None:
+			# Packed float32s rather than an array of BSON doubles
+			value['delay_sequence'] = Binary(pack_delays(value['delay_sequence']))
+		return dct
+
+	def _result_day(self, timestamp):
+		return int(timestamp // RESULT_BUCKET_SECONDS)
+
+	def _result_expiry(self, day):
+		return datetime.utcfromtimestamp(
+			(day + 1) * RESULT_BUCKET_SECONDS + RESULT_RETENTION)
+
+	def get_results(self, uuid, target_uuid=None, since=0):
+		"""
+		Yields the result dicts of a peer, optionally only those to
+		target_uuid, from the buckets of the days since timestamp since.
+		Their delay sequences are packed, see cheesepi.codec.
+		"""
+		query = {'peer':uuid, 'day':{'$gte':self._result_day(since)}}
+		if target_uuid is not None:
+			query['target'] = target_uuid
+
+		cursor = self.db.results.find(query, {'results':1}).sort(
+			'day', pymongo.ASCENDING)
+		for bucket in cursor:
+			for result in bucket['results']:
+				if result['start_time'] >= since:
+					yield result
+
+	def _result_key(self, uuid, result):
+		"""
+		Compact identity of a result, an MD5 digest of its peer, task,
+		start time and target. The start time is a float whatever it was
+		decoded as, columnar dumps give integral ones as ints.
+		"""
+		key = "{}|{}|{!r}|{}".format(uuid, result.get_taskname(),
+		                             float(result.get_start_time()),
+		                             result.get_target().get_uuid())
+		return hashlib.md5(key.encode('utf-8')).digest()
+
+	def claim_results(self, uuid, results):
+		"""
+		Returns the results of peer uuid that have not been stored before,
+		and records them as pending to be stored, so that results which are
+		uploaded again are only counted once. Once the results are in their
+		buckets, confirm_results must be called, or release_results if
+		storing them failed. The unique keys in result_keys decide, the
+		bloom filter only saves trying to insert the keys of results that
+		were most likely stored already.
+
+		Keys left pending, by a process that stopped before confirming
+		them, are checked against the buckets: the results found there
+		are duplicates, the rest are claimed again.
+
+		Args:
+			uuid: a peer uuid
+			results: a list of Result objects
+		Returns:
+			the list of new Result objects, in order. Results without a
+			start time are left out, they can not be stored
+		"""
+		keyed = [(self._result_key(uuid, result), result) for result in results
+		         if result.get_start_time() is not None]
+		start_times = dict((key, result.get_start_time()) for key, result in keyed)
+
+		# key -> whether it is pending, for the keys in result_keys
+		existing = self._result_key_states(
+			[key for key in start_times if key in self._seen_results])
+
+		new_keys = [key for key in start_times if key not in existing]
+		taken = set()
+		if len(new_keys) > 0:
+			try:
+				self.db.result_keys.insert_many(
+					[{'_id':Binary(key),
+					  'pending':True,
+					  'expires':self._result_expiry(self._result_day(start_times[key]))}
+					 for key in new_keys],
+					ordered=False
+				)
+			except BulkWriteError as e:
+				# In result_keys already, e.g. after a restart emptied the
+				# bloom filter, or stored since the lookup by another worker
+				for error in e.details['writeErrors']:
+					if error['code'] != DUPLICATE_KEY:
+						raise
+					taken.add(new_keys[error['index']])
+				existing.update(self._result_key_states(list(taken)))
+
+		for key in start_times:
+			self._seen_results.add(key)
+
+		claimed = set(new_keys) - taken
+		pending = [key for key, is_pending in existing.items() if is_pending]
+		if len(pending) > 0:
+			stored = self._stored_result_keys(uuid, pending)
+			self._confirm_keys(stored)
+			claimed.update(key for key in pending if key not in stored)
+			self.log.info("Reclaimed {} of {} pending results of {}".format(
+				len(pending) - len(stored), len(pending), uuid))
+
+		new_results = []
+		for key, result in keyed:
+			if key in claimed:
+				# Duplicates within the list count once too
+				claimed.discard(key)
+				new_results.append(result)
+
+		if len(new_results) < len(keyed):
+			self.log.info("Skipping {} duplicate results of {}".format(
+				len(keyed) - len(new_results), uuid))
+		if len(keyed) < len(results):
+			self.log.warn("Skipping {} results of {} without a start time".format(
+				len(results) - len(keyed), uuid))
+		return new_results
+
+	def _result_key_states(self, keys):
+		"""
+		Returns a dict of which of keys are in result_keys, to whether
+		they are pending.
+		"""
+		if len(keys) == 0:
+			return {}
+		cursor = self.db.result_keys.find(
+			{'_id':{'$in':[Binary(key) for key in keys]}},
+			{'pending':1}
+		)
+		return dict((bytes(doc['_id']), doc.get('pending', False)) for doc in cursor)
+
+	def _stored_result_keys(self, uuid, keys):
+		"""
+		Returns the set of keys whose results are in the buckets of peer
+		uuid.
+		"""
+		wanted = [Binary(key) for key in keys]
+		cursor = self.db.results.find(
+			{'peer':uuid, 'results.key':{'$in':wanted}},
+			{'results.key':1}
+		)
+		keys = set(keys)
+		stored = set()
+		for bucket in cursor:
+			for result in bucket['results']:
+				key = bytes(result.get('key', b''))
+				if key in keys:
+					stored.add(key)
+		return stored
+
+	def _confirm_keys(self, keys):
+		if len(keys) > 0:
+			self.db.result_keys.update_many(
+				{'_id':{'$in':[Binary(key) for key in keys]}},
+				{'$unset':{'pending':''}}
+			)
+
+	def confirm_results(self, uuid, results):
+		"""
+		Record that claimed results are stored in their buckets.
+		"""
+		self._confirm_keys([self._result_key(uuid, result) for result in results])
+
+	def release_results(self, uuid, results):
+		"""
+		Forget that results were stored, when storing them failed after
+		they were claimed with claim_results.
+		"""
+		keys = [Binary(self._result_key(uuid, result)) for result in results]
+		if len(keys) > 0:
+			self.db.result_keys.delete_many({'_id':{'$in':keys}})
+
+	def is_upload_processed(self, md5_hash):
+		return self.db.uploads.find_one({'_id':md5_hash}, {'_id':1}) is not None
+
+	def set_upload_processed(self, md5_hash):
+		self.db.uploads.update_one(
+			{'_id':md5_hash},
+			{'$set':{
+				'processed':time.time(),
+				'expires':datetime.utcfromtimestamp(time.time() + RESULT_RETENTION),
+				}
+			},
+			upsert=True
 		)
+
+	def purge_results(self, uuid):
+		result = self.db.results.delete_many({'peer':uuid})
 		return result
 
 	def purge_results_older_than(self, uuid, timestamp):
-		result = self.db.peers.update(
-			{'uuid':uuid},
-			{'$pull': {
-				'results':{
-					'timestamp':{'$lt': timestamp}
-					}
-				}
+		"""
+		Drops the buckets of the days before the one of timestamp, results
+		from earlier that day are kept until their bucket is dropped.
+		"""
+		result = self.db.results.delete_many(
+			{'peer':uuid,
+			 'day':{'$lt': self._result_day(timestamp)}
 			}
 		)
 		return result
 
+	def migrate_peer_results(self):
+		"""
+		Move the results that older versions pushed into the peer
+		documents into result buckets. Run once after upgrading. Each
+		peer's results are unset right after they have been bucketed, so
+		if interrupted only the peer being moved can end up duplicated.
+
+		Returns:
+			the number of results moved
+		"""
+		from cheesepi.server.storage.models.result import Result
+
+		moved = 0
+		cursor = self.db.peers.find({'results':{'$exists':True}},
+		                            {'uuid':1, 'results':1})
+		for peer in cursor:
+			results = []
+			for dct in peer['results']:
+				try:
+					results.append(Result.fromDict(dct))
+				except Exception as e:
+					self.log.warn("Dropping result of {}: {}".format(peer['uuid'], e))
+
+			if len(results) > 0:
+				bulk_writer = self.get_results_bulk_writer()
+				self.bulk_write_results(bulk_writer, peer['uuid'], results).execute()
+			self.db.peers.update_one({'_id':peer['_id']}, {'$unset':{'results':""}})
+			moved = moved + len(results)
+		self.log.info("Moved {} results into result buckets".format(moved))
+		return moved
+
 
 ### DEPRECATED ###
 	def write_task(self, uuid, task):
@@ -1,32 +1,185 @@
 from __future__ import unicode_literals, absolute_import, print_function
 
 import os
+import re
+import json
+import time
 import hashlib
 import random
+from collections import OrderedDict
 
 from twisted.web import server
 from twisted.web.resource import Resource
-from twisted.internet import reactor, defer
 
 UPLOAD_PATH = "/tmp/cheesepi/"
+# Received archives waiting to be processed
+QUEUE_PATH = os.path.join(UPLOAD_PATH, "queue")
+# Partially received chunked uploads, named by their upload_id
+STAGING_PATH = os.path.join(UPLOAD_PATH, "staging")
+UPLOAD_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+# Staged uploads without a chunk for this many seconds are abandoned
+STAGING_EXPIRY = 86400
+# How many running MD5s are kept, others are read again from their file
+MAX_HASHERS = 100
 
 class UploadHandler(Resource):
 
-	def __init__(self):
-		self._upload_queue = []
-
-		if not os.path.exists(UPLOAD_PATH):
-			os.makedirs(UPLOAD_PATH)
-
-	def _process_upload(self):
-		from cheesepi.server.processing.utils import process_upload
+	def __init__(self, upload_queue=None):
+		Resource.__init__(self)
+		if upload_queue is None:
+			from cheesepi.server.processing.UploadQueue import UploadQueue
+			upload_queue = UploadQueue(QUEUE_PATH)
+			upload_queue.recover()
+		self._upload_queue = upload_queue
+		# Running MD5 of recently active staged uploads, updated as chunks
+		# arrive, least recently used first
+		self._hashers = OrderedDict()
+		self._expired_at = 0
+
+		if not os.path.exists(STAGING_PATH):
+			os.makedirs(STAGING_PATH)
+
+	def _queue_upload(self, request, filename, md5_hash=None):
+		"""
+		Hand a received archive to the processing queue and respond
+		with 202 Accepted, without waiting for it to be processed.
+		"""
+		upload_size = os.stat(filename).st_size
+		self._upload_queue.put(filename, md5_hash)
+		response = b"Queued upload of size {} bytes\n".format(upload_size)
+		return self._respond(request, response, 202)
 
-		filename = self._upload_queue.pop(0)
+	def _respond(self, request, response, code=200):
+		request.setResponseCode(code)
+		request.setHeader(b'Content-Length', b"{}".format(len(response)))
+		request.write(response)
+		request.finish()
+		return server.NOT_DONE_YET
 
-		# This call is blocking so it will run until done...
-		process_upload(filename)
+	def _staging_file(self, request):
+		"""
+		Path of the staging file of a chunked upload, None if the request
+		has no valid upload_id.
+		"""
+		if 'upload_id' not in request.args:
+			return None
+		upload_id = request.args['upload_id'][0]
+		if not UPLOAD_ID_PATTERN.match(upload_id):
+			return None
+		return os.path.join(STAGING_PATH, upload_id + ".part")
+
+	def render_GET(self, request):
+		"""
+		How many bytes of a chunked upload have been received, so a client
+		can resume from there.
+		"""
+		staging_file = self._staging_file(request)
+		if staging_file is None:
+			return self._respond(request, b"Invalid upload_id\n", 400)
+		offset = 0
+		if os.path.exists(staging_file):
+			offset = os.stat(staging_file).st_size
+		return self._respond(request, b"{}".format(offset))
 
 	def render_POST(self, request):
+		"""
+		Either a whole archive as the 'file' form field, or a part of a
+		chunked upload: a chunk as the request body with upload_id and
+		offset parameters, or the final request with upload_id, complete,
+		filename and md5_hash parameters.
+		"""
+		if 'upload_id' not in request.args:
+			return self._render_whole_upload(request)
+
+		staging_file = self._staging_file(request)
+		if staging_file is None:
+			return self._respond(request, b"Invalid upload_id\n", 400)
+		if 'complete' in request.args:
+			return self._render_complete(request, staging_file)
+		return self._render_chunk(request, staging_file)
+
+	def _render_chunk(self, request, staging_file):
+		"""
+		Append a chunk to the staging file, if it starts where the
+		staged data ends. Responds with the new size of the staged data.
+		"""
+		received = 0
+		if os.path.exists(staging_file):
+			received = os.stat(staging_file).st_size
+		try:
+			offset = int(request.args['offset'][0])
+		except (KeyError, ValueError):
+			return self._respond(request, b"Invalid offset\n", 400)
+		if offset != received:
+			# Tell the client where to continue from
+			return self._respond(request, b"{}".format(received), 409)
+
+		self._expire_staging()
+		hasher = self._get_hasher(staging_file)
+		request.content.seek(0)
+		with open(staging_file, 'ab') as fd:
+			for block in iter(lambda: request.content.read(65536), b""):
+				fd.write(block)
+				hasher.update(block)
+		return self._respond(request, b"{}".format(os.stat(staging_file).st_size))
+
+	def _render_complete(self, request, staging_file):
+		"""
+		Check the hash of the staged data and process it as an upload.
+		"""
+		if not os.path.exists(staging_file):
+			return self._respond(request, b"Unknown upload_id\n", 404)
+
+		upload_hash = self._get_hasher(staging_file).hexdigest()
+		self._hashers.pop(staging_file, None)
+		md5_hash = request.args.get('md5_hash', [None])[0]
+		if md5_hash != upload_hash:
+			# Corrupt, the client will have to start over
+			os.remove(staging_file)
+			return self._respond(request, b"Hash does not match\n", 400)
+
+		prefix = str(random.randint(1000,9999))
+		filename = os.path.join(self._upload_queue.get_path(), prefix + "_" +
+			os.path.basename(request.args.get('filename', ["upload.tgz"])[0]))
+		os.rename(staging_file, filename)
+		return self._queue_upload(request, filename, upload_hash)
+
+	def _get_hasher(self, staging_file):
+		"""
+		The running MD5 of a staging file. It is only read from disk
+		when there is none, i.e. after a restart or if the upload has not
+		been active for a while.
+		"""
+		hasher = self._hashers.pop(staging_file, None)
+		if hasher is None:
+			hasher = hashlib.md5()
+			if os.path.exists(staging_file):
+				with open(staging_file, 'rb') as fd:
+					for block in iter(lambda: fd.read(65536), b""):
+						hasher.update(block)
+		self._hashers[staging_file] = hasher # most recently used
+		while len(self._hashers) > MAX_HASHERS:
+			self._hashers.popitem(last=False)
+		return hasher
+
+	def _expire_staging(self):
+		"""
+		Remove abandoned staging files, at most once an hour.
+		"""
+		now = time.time()
+		if now - self._expired_at < 3600:
+			return
+		self._expired_at = now
+		for name in os.listdir(STAGING_PATH):
+			staging_file = os.path.join(STAGING_PATH, name)
+			try:
+				if now - os.path.getmtime(staging_file) > STAGING_EXPIRY:
+					os.remove(staging_file)
+					self._hashers.pop(staging_file, None)
+			except OSError:
+				pass # completed or removed meanwhile
+
+	def _render_whole_upload(self, request):
 
 		prefix = str(random.randint(1000,9999))
 		filename = os.path.join(UPLOAD_PATH,
@@ -46,23 +199,19 @@ class UploadHandler(Resource):
 		with open(filename, 'wb') as fd:
 				fd.write(request.args['file'][0])
 
-		upload_size = os.stat(filename).st_size
+		return self._queue_upload(request, filename, upload_hash)
 
-		# Schedule processing of file one second later
-		# NOTE: Maybe we'd like to chain together the completion of the
-		#       write with the processing using a callback?
-		from cheesepi.server.processing.utils import process_upload
-		#self._upload_queue.append(filename)
-		#reactor.callLater(0.1, self._process_upload)
-		result = process_upload(filename)
 
-		response = (b"Received upload of size {} bytes\n".format(upload_size)
-		          + b"Result is {}".format(result)
-		)
-		request.setHeader(b'Content-Length', len(response))
+class UploadQueueStatus(Resource):
+	"""
+	Queue depth and processing latency of the upload queue, as JSON.
+	"""
+	isLeaf = True
 
-		request.write(response)
+	def __init__(self, upload_queue):
+		Resource.__init__(self)
+		self._upload_queue = upload_queue
 
-		request.finish()
-
-		return server.NOT_DONE_YET
+	def render_GET(self, request):
+		request.setHeader(b'Content-Type', b'application/json')
+		return json.dumps(self._upload_queue.get_stats()).encode('utf-8')
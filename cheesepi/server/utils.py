@@ -56,7 +56,7 @@ def start_control_server():
 	#globalLogPublisher.addObserver(PrintingObserver())
 
 	#dao = MongoDAO()
-	dao = MongoDAO('localhost', 27017)
+	dao = MongoDAO.shared('localhost', 27017)
 	control_server = CheeseRPCServer(dao).getStreamFactory(CheeseRPCServerFactory)
 
 	reactor.listenTCP(args.port, control_server)
@@ -71,12 +71,17 @@ def start_upload_server():
 	from twisted.web.server import Site
 	from twisted.web.resource import Resource
 
-	from cheesepi.server.upload import UploadHandler
+	from cheesepi.server.upload import (UploadHandler, UploadQueueStatus,
+	                                    QUEUE_PATH)
+	from cheesepi.server.processing.UploadQueue import UploadQueue
+	from cheesepi.server.storage.mongo import MongoDAO
 
 	# Argument parsing
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--port', type=int, default=18090,
 	                    help='Port to listen on')
+	parser.add_argument('--workers', type=int, default=4,
+	                    help='Number of uploads processed concurrently')
 	args = parser.parse_args()
 
 	init_logging()
@@ -87,8 +92,19 @@ def start_upload_server():
 	# Use twisted logger when in twisted
 	log = Logger()
 
+	# Connect (which creates the indexes) before any upload arrives, the
+	# workers share this DAO's connection pool
+	MongoDAO.shared('localhost', 27017)
+
+	# Uploads are processed in worker threads, draining a queue directory
+	upload_queue = UploadQueue(QUEUE_PATH, workers=args.workers)
+	recovered = upload_queue.recover()
+	if recovered > 0:
+		log.info("Processing %d uploads queued before restart..." % recovered)
+
 	root = Resource()
-	root.putChild("upload", UploadHandler())
+	root.putChild("upload", UploadHandler(upload_queue))
+	root.putChild("status", UploadQueueStatus(upload_queue))
 	upload_server = Site(root)
 
 	reactor.listenTCP(args.port, upload_server)
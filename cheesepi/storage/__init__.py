@@ -1,19 +1,26 @@
 import dao
+import dao_buffered
+
+# the DAO modules, cheesepi.config picks one as cp.storage.<module>
+__all__ = ['dao', 'dao_buffered']
 
 try:
 	import dao_mongo
+	__all__ += ['dao_mongo']
 except ImportError as e:
 	print "Missing Mongo python module (and GridFS and bson), use 'pip install pymongo'"
 	print str(e)
 
 try:
 	import dao_influx08
+	__all__ += ['dao_influx08']
 except ImportError as e:
 	print "Missing InfluxDB python module, use 'pip install influxdb'"
 	print str(e)
 
 try:
 	import dao_influx09
+	__all__ += ['dao_influx09']
 except ImportError as e:
 	print "Missing InfluxDB python module, use 'pip install influxdb'"
 	print str(e)
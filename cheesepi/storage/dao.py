@@ -29,6 +29,8 @@ Description: Abstract class to be subclassed by specific database storage engine
 
 import logging
 
+import cheesepi as cp
+
 class DAO:
 	def __init__(self):
 		pass
@@ -44,6 +46,39 @@ class DAO:
 		logging.error(msg)
 		return msg
 
+	def dump_chunks(self, marks, since=-1, chunk_size=1000):
+		"""Yield (series, columns, values, high_water) for every series, in
+		time order and at most chunk_size points at a time. Only points
+		after marks[series] are dumped, or after since (in seconds) for
+		series without a mark. high_water is the mark to resume from."""
+		logging.error("Method not implemented in this DAO class")
+		return []
+
+	def resume_mark(self, mark, since):
+		"""(time, points already dumped at that time) to continue a dump
+		from, time in the database's own unit. Marks are [time, count],
+		those of older versions just the time of the last dumped point"""
+		if mark is None:
+			return since + 1, 0
+		if isinstance(mark, list):
+			return mark[0], mark[1]
+		return mark + 1, 0 # every point at that time was dumped
+
+	def next_mark(self, mark_time, dumped, times):
+		"""The [time, count] mark after dumping points at times (ascending)
+		from mark_time, where dumped points had already been dumped. Points
+		sharing the last time may not have all fit in the chunk, so the
+		next chunk starts at that time and skips those counted"""
+		last = times[-1]
+		count = 0
+		for t in reversed(times):
+			if t != last:
+				break
+			count += 1
+		if last == mark_time:
+			count += dumped
+		return [last, count]
+
 	def slurp(self):
 		"""Ingest many data points at once"""
 		logging.error("Method not implemented in this DAO class")
@@ -75,6 +110,42 @@ class DAO:
 
 # The following need not be reimplemented in subclasses
 
+	def write_ops(self, op_type, dics):
+		"""Write many ops of the same type. Subclasses should override this
+		to write them all in one request to the database"""
+		return [self.write_op(op_type, dic) for dic in dics]
+
+	def stamp_ops(self, dics):
+		"""Set the 'time' of each op without one to its measurement time,
+		its start_time or else now, in nanoseconds. Times are made unique
+		within dics, points of a measurement written with the same time
+		overwrite each other in InfluxDB 0.9"""
+		now = cp.utils.now()
+		used = set()
+		for dic in dics:
+			if 'time' not in dic:
+				try:
+					start_time = float(dic['start_time'])
+				except (KeyError, TypeError, ValueError):
+					start_time = now
+				dic['time'] = int(round(start_time * 10**9))
+			while dic['time'] in used:
+				dic['time'] += 1
+			used.add(dic['time'])
+		return dics
+
+	def flush(self):
+		"""Write any ops held back to be written later, see DAO_buffered"""
+		pass
+
+	def sign_op(self, dic, config=None):
+		"""Add the version and signature fields to an op before it is stored"""
+		if config==None:
+			config = cp.config.get_config()
+		dic['version'] = config['version']
+		dic['sign']    = config.sign(str(dic))
+		return dic
+
 	def validate_op(self, op_type):
 		# should check the op is structured correctly
 		return True
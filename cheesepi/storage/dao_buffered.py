@@ -0,0 +1,205 @@
+""" Copyright (c) 2015, Swedish Institute of Computer Science
+  All rights reserved.
+  Redistribution and use in source and binary forms, with or without
+  modification, are permitted provided that the following conditions are met:
+	  * Redistributions of source code must retain the above copyright
+		notice, this list of conditions and the following disclaimer.
+	  * Redistributions in binary form must reproduce the above copyright
+		notice, this list of conditions and the following disclaimer in the
+		documentation and/or other materials provided with the distribution.
+	  * Neither the name of The Swedish Institute of Computer Science nor the
+		names of its contributors may be used to endorse or promote products
+		derived from this software without specific prior written permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+ WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+ DISCLAIMED. IN NO EVENT SHALL THE SWEDISH INSTITUTE OF COMPUTER SCIENCE BE LIABLE
+ FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+ (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Authors: ljjm@sics.se
+Testers:
+Description: Write-behind wrapper around another DAO. Ops are queued in
+memory and written in batches by a background thread, either when enough
+have queued or when they have waited long enough. If the database can not
+take a batch, it is appended to a local spool file (one JSON op per line),
+which is replayed, in order, before any later batch is written.
+"""
+
+import os
+import json
+import time
+import fcntl
+import atexit
+import threading
+from collections import deque
+
+import cheesepi as cp
+import dao
+
+logger = cp.config.get_logger(__name__)
+
+class DAO_buffered(dao.DAO):
+	def __init__(self, dao, spool_file, flush_size=100, flush_interval=10, retry_interval=60):
+		self.dao            = dao
+		self.spool_file     = spool_file
+		self.flush_size     = flush_size
+		self.flush_interval = flush_interval
+		self.retry_interval = retry_interval
+		# hold at most a few batches, older ops go to the spool when full
+		self.buffer  = deque(maxlen=flush_size*10)
+		self.lock    = threading.Lock()
+		self.wakeup  = threading.Event()
+		self.flusher = None
+		self.flusher_pid = None
+		self.retry_after = 0 # do not try the database before this time
+		atexit.register(self.flush)
+
+	def close(self):
+		self.flush()
+		self.dao.close()
+
+	def make_database(self, name):
+		return self.dao.make_database(name)
+
+	def dump(self, since=-1):
+		return self.dao.dump(since)
+
+	def dump_chunks(self, marks, since=-1, chunk_size=1000):
+		self.flush() # include what is still queued
+		return self.dao.dump_chunks(marks, since, chunk_size)
+
+	def slurp(self, *args):
+		return self.dao.slurp(*args)
+
+	def read_op(self, op_type, timestamp=0, limit=100):
+		return self.dao.read_op(op_type, timestamp, limit)
+
+	def read_user_attribute(self, attribute):
+		return self.dao.read_user_attribute(attribute)
+
+	def write_user_attribute(self, attribute, value):
+		return self.dao.write_user_attribute(attribute, value)
+
+	# Operator interactions
+	def write_op(self, op_type, dic, binary=None):
+		"""Queue the op, returns True rather than the id of the stored op"""
+		if binary!=None: # binaries are too big to queue
+			return self.dao.write_op(op_type, dic, binary)
+		return self.write_ops(op_type, [dic])
+
+	def write_ops(self, op_type, dics):
+		"""Queue the ops and return straight away"""
+		self.ensure_flusher()
+		# stored with when they were measured, not when they are flushed
+		dics = self.stamp_ops([dict(dic) for dic in dics])
+		with self.lock:
+			if len(self.buffer) + len(dics) > self.buffer.maxlen:
+				self.spill(self.take())
+			for dic in dics:
+				self.buffer.append((op_type, dic))
+			full = len(self.buffer) >= self.flush_size
+		if full:
+			self.wakeup.set()
+		return True
+
+	def ensure_flusher(self):
+		"""Start the flushing thread, again if we have been forked"""
+		if self.flusher_pid == os.getpid():
+			return
+		self.flusher_pid = os.getpid()
+		self.flusher = threading.Thread(target=self.flush_loop, name="dao-flusher")
+		self.flusher.daemon = True
+		self.flusher.start()
+
+	def flush_loop(self):
+		while True:
+			self.wakeup.wait(self.flush_interval)
+			self.wakeup.clear()
+			try:
+				self.flush()
+			except BaseException as e:
+				# even SystemExit, this thread must keep flushing
+				logger.error("Flushing buffered ops failed: "+repr(e))
+
+	def take(self):
+		"""Empty the buffer, caller holds self.lock"""
+		ops = list(self.buffer)
+		self.buffer.clear()
+		return ops
+
+	def flush(self):
+		"""Write the spool and then the buffer to the database, spool the
+		buffer instead if the database is not available"""
+		with self.lock:
+			ops = self.take()
+		if time.time() < self.retry_after or not self.replay():
+			self.spill(ops)
+			return False
+		if not self.write_batches(ops):
+			self.spill(ops)
+			return False
+		return True
+
+	def write_batches(self, ops):
+		"""Write ops with one write_ops() per run of the same op type,
+		return whether all of them were written"""
+		start = 0
+		while start < len(ops):
+			op_type = ops[start][0]
+			end = start
+			while end < len(ops) and ops[end][0]==op_type:
+				end += 1
+			try:
+				written = self.dao.write_ops(op_type, [dict(d) for t,d in ops[start:end]])
+			except (Exception, SystemExit) as e: # some DAOs exit() on failure
+				logger.warning("Writing %s ops failed: %s" % (op_type, e))
+				written = None
+			if not written:
+				self.retry_after = time.time() + self.retry_interval
+				del ops[:start] # only keep what was not written
+				return False
+			start = end
+		return True
+
+	## Spool file, shared by all processes
+	def spill(self, ops):
+		if len(ops)==0:
+			return
+		logger.warning("Database unavailable, spooling %d ops to %s" % (len(ops), self.spool_file))
+		with open(self.spool_file, "a") as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			for op_type, dic in ops:
+				f.write(json.dumps([op_type, dic])+"\n")
+			f.flush()
+			fcntl.flock(f, fcntl.LOCK_UN)
+
+	def replay(self):
+		"""Write all spooled ops, return False if some could not be"""
+		if not os.path.isfile(self.spool_file):
+			return True
+		with open(self.spool_file, "r+") as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			ops = []
+			for line in f:
+				try:
+					ops.append(tuple(json.loads(line)))
+				except ValueError:
+					logger.error("Dropping corrupt spooled op: "+line)
+			if len(ops) > 0:
+				logger.info("Replaying %d spooled ops" % len(ops))
+			written = self.write_batches(ops)
+			# keep whatever was not written, in order
+			f.seek(0)
+			f.truncate()
+			if not written:
+				for op_type, dic in ops:
+					f.write(json.dumps([op_type, dic])+"\n")
+			f.flush()
+			fcntl.flock(f, fcntl.LOCK_UN)
+		return written
@@ -28,7 +28,6 @@ Testers:
 
 import sys
 import logging
-import hashlib
 import json
 
 import cheesepi as cp
@@ -105,6 +104,35 @@ class DAO_influx(dao.DAO):
 			dumped_db[series_name] = json.dumps(dumped_series)
 		return dumped_db
 
+	def dump_chunks(self, marks, since=-1, chunk_size=1000):
+		try:
+			series_list = self.conn.query("list series")
+		except Exception as e:
+			msg = "Problem connecting to InfluxDB when listing series: "+str(e)
+			print msg
+			logging.error(msg)
+			return
+		for series_name in self.extract_series(series_list) or []:
+			# marks are of microsecond timestamps, see resume_mark()
+			mark_time, dumped = self.resume_mark(marks.get(series_name), int(since*1e6))
+			while True:
+				limit = chunk_size + dumped
+				result = self.conn.query('select * from %s where time >= %du order asc limit %d;' % (series_name, mark_time, limit), time_precision='u')
+				if result==[]:
+					break
+				columns = result[0]['columns']
+				values  = result[0]['points']
+				last_chunk = len(values) < limit
+				values = values[dumped:] # already dumped at mark_time
+				if len(values)==0:
+					break
+				time_index = columns.index('time')
+				mark = self.next_mark(mark_time, dumped, [v[time_index] for v in values])
+				mark_time, dumped = mark
+				yield series_name, columns, values, mark
+				if last_chunk:
+					break
+
 	def format09(self,table,dic):
 		#print [{"measurement":table,"fields":dic}]
 		return [{'measurement':table,"database": "cheesepi","fields":dic,"tags": {"source":"dao"} }]
@@ -118,6 +146,17 @@ class DAO_influx(dao.DAO):
 		#json_str = '[{"name":"ping", "columns":["test"], "points":["value"]}]'
 		return json_str
 
+	def format08_many(self, table, dics):
+		"""A single series holding every dic, columns are the union of their
+		keys and missing values are null"""
+		columns = []
+		for dic in dics:
+			for k in dic.keys():
+				if k not in columns:
+					columns.append(k)
+		points = [[dic.get(k) for k in columns] for dic in dics]
+		return json.dumps([{"name":table, "columns":columns, "points":points}])
+
 	def slurp(self, op_type, points):
 		"""Short cut to database write, useful for bulk writes"""
 		#self.conn.write_points(op_type, points, batch_size=50)
@@ -131,10 +170,7 @@ class DAO_influx(dao.DAO):
 		#if binary!=None:
 		#	 # save binary, check its not too big
 		#	 dic['binary'] = bson.Binary(binary)
-		config = cp.config.get_config()
-		dic['version'] = config['version']
-		md5 = hashlib.md5(config['secret']+str(dic)).hexdigest()
-		dic['sign']    = md5
+		self.sign_op(dic)
 
 		json = self.format08(op_type, dic)
 		print "Saving %s Op: %s" % (op_type, json)
@@ -149,6 +185,30 @@ class DAO_influx(dao.DAO):
 			raise IOError(msg)
 		return id
 
+	def write_ops(self, op_type, dics):
+		"""Write all ops of op_type as one series in one request"""
+		if len(dics)==0:
+			return True
+		if not self.validate_op(op_type):
+			logging.warning("Operation of type %s not valid" % op_type)
+			return
+		config = cp.config.get_config()
+		if len([dic for dic in dics if 'time' in dic]) > 0:
+			self.stamp_ops(dics) # a time column needs a value in every point
+		for dic in dics:
+			self.sign_op(dic, config)
+			if 'time' in dic: # nanoseconds, see stamp_ops()
+				dic['time'] = dic['time'] // 1000
+		json = self.format08_many(op_type, dics)
+		print "Saving %d %s Ops" % (len(dics), op_type)
+		try:
+			return self.conn.write_points(json, time_precision='u')
+		except Exception as e:
+			msg = "Database Influx "+op_type+" Ops write failed! "+str(e)
+			logging.error(msg)
+			print msg
+			raise IOError(msg)
+
 	def read_op(self, op_type, timestamp=0, limit=100):
 		op = self.conn.query('select * from '+op_type+' limit 1;')
 		return op
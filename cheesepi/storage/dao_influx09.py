@@ -28,7 +28,6 @@ Testers:
 
 import sys
 import logging
-import hashlib
 import json
 import traceback
 from requests.exceptions import ConnectionError
@@ -94,10 +93,45 @@ class DAO_influx(dao.DAO):
 		return dumped_db
 
 
+	def dump_chunks(self, marks, since=-1, chunk_size=1000):
+		try:
+			measurements = self.conn.get_list_measurements()
+		except Exception as e:
+			msg = "Problem connecting to InfluxDB when listing series: "+str(e)
+			logger.error(msg)
+			logger.exception(e)
+			return
+
+		for m in measurements:
+			series_name = m['name']
+			# marks are of nanosecond timestamps, as returned with epoch='ns', see resume_mark()
+			mark_time, dumped = self.resume_mark(marks.get(series_name), int(since*1e9))
+			while True:
+				limit = chunk_size + dumped
+				result = self.conn.query('select * from "%s" where time >= %d order by time asc limit %d;' % (series_name, mark_time, limit), epoch='ns')
+				series = result.raw.get('series', [])
+				if len(series)==0:
+					break
+				columns = series[0]['columns']
+				values  = series[0]['values']
+				last_chunk = len(values) < limit
+				values = values[dumped:] # already dumped at mark_time
+				if len(values)==0:
+					break
+				time_index = columns.index('time')
+				mark = self.next_mark(mark_time, dumped, [v[time_index] for v in values])
+				mark_time, dumped = mark
+				yield series_name, columns, values, mark
+				if last_chunk:
+					break
 
 	def format09(self,table,dic):
 		#print [{"measurement":table,"fields":dic}]
-		return [{'measurement':table, "database":"cheesepi", "fields":dic, "tags":{"source":"dao"} }]
+		point = {'measurement':table, "database":"cheesepi", "fields":dic, "tags":{"source":"dao"} }
+		if 'time' in dic: # nanoseconds, see stamp_ops()
+			point['fields'] = dict(dic)
+			point['time'] = point['fields'].pop('time')
+		return [point]
 		#return json_body
 
 
@@ -119,10 +153,7 @@ class DAO_influx(dao.DAO):
 		#if binary!=None:
 		#	 # save binary, check its not too big
 		#	 dic['binary'] = bson.Binary(binary)
-		config = cp.config.get_config()
-		dic['version'] = config['version']
-		md5 = hashlib.md5(config['secret']+str(dic)).hexdigest()
-		dic['sign']    = md5
+		self.sign_op(dic)
 
 		points=self.format09(op_type, dic)
 		logger.debug(points)
@@ -147,6 +178,35 @@ class DAO_influx(dao.DAO):
 			return None
 		return result
 
+	def write_ops(self, op_type, dics):
+		"""Write all ops of op_type in a single write_points() request"""
+		if len(dics)==0:
+			return True
+		if not self.validate_op(op_type):
+			logger.warning("Operation of type %s not valid" % op_type)
+			return
+		config = cp.config.get_config()
+		# untimed points of one request all get the same time, and would
+		# overwrite each other
+		self.stamp_ops(dics)
+		points = []
+		for dic in dics:
+			points.extend(self.format09(op_type, self.sign_op(dic, config)))
+		logger.info("Saving %d %s Ops" % (len(points), op_type))
+		try:
+			return self.conn.write_points(points)
+		except InfluxDBClientError as e:
+			if e.code==204: # success!
+				return True
+			traceback.print_exc()
+		except ConnectionError as e:
+			logger.error("Database connection error, is the database server running?")
+		except Exception as e:
+			msg = "Database Influx "+op_type+" Ops write failed! "+str(e)
+			logger.error(msg)
+			logger.exception(e)
+		return None
+
 	def read_op(self, op_type, timestamp=0, limit=100):
 		op = self.conn.query('select * from '+op_type+' limit 1;')
 		return op
@@ -27,7 +27,6 @@ Testers:
 """
 
 import logging
-import hashlib
 
 # PyMongo
 import pymongo
@@ -64,20 +63,35 @@ class DAO_mongo(dao.DAO):
         if binary!=None:
             # save binary, check its not too big
             dic['binary'] = bson.Binary(binary)
-        config = cp.config.get_config()
-        dic['version'] = config['version']
-        md5 = hashlib.md5(config['secret']+str(dic)).hexdigest()
-        dic['sign']    = md5
+        self.sign_op(dic)
 
         print "Saving %s Operation: %s" % (op_type, dic)
         try:
             id = collection.insert(dic)
         except:
-            logging.error("Database PyMongo write failed!")
-            exit(1)
+            logging.exception("Database PyMongo write failed!")
+            return None
         return id
 
 
+    def write_ops(self, op_type, dics):
+        """Insert all ops of op_type in one request, returns their ids"""
+        if len(dics)==0:
+            return []
+        if not self.validate_op(op_type):
+            return
+        config = cp.config.get_config()
+        for dic in dics:
+            self.sign_op(dic, config)
+        print "Saving %d %s Operations" % (len(dics), op_type)
+        try:
+            ids = self.db[op_type].insert(dics)
+        except:
+            logging.exception("Database PyMongo write failed!")
+            return None
+        return ids
+
+
     def read_op(self, op_type, timestamp=0, limit=100):
         rv=""
         if not self.validate_op(op_type):
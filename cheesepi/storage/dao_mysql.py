@@ -91,6 +91,23 @@ class DAO_mysql(dao.DAO):
 			self.conn.commit()
 
 
+	def write_ops(self, op_type, dics):
+		"""Insert all ops of op_type in one transaction, one executemany()
+		per distinct set of columns"""
+		groups = {}
+		for dic in dics:
+			names = tuple(sorted(dic.keys()))
+			groups.setdefault(names, []).append([dic[k] for k in names])
+		with self.conn:
+			cursor = self.conn.cursor();
+			for names, rows in groups.iteritems():
+				query = """INSERT INTO %s (%s) VALUES (%s)""" % (op_type,
+					", ".join(names), ", ".join(["%s"]*len(names)))
+				cursor.executemany(query, rows)
+			self.conn.commit()
+		return True
+
+
 	def read_op(self, op_type, timestamp=0, limit=100):
 	#check last push and grab the rest?
 		pass
@@ -1,8 +1,6 @@
 import time
 import os
 import re
-import logging
-import socket
 
 import Task
 import cheesepi as cp
@@ -17,39 +15,33 @@ class Httping(Task.Task):
 		self.spec['taskname'] = "httping"
 		if not 'landmark'    in self.spec: self.spec['landmark']    = "www.sics.se"
 		if not 'ping_count'  in self.spec: self.spec['ping_count']  = 10
-		try:
-			socket.gethostbyname(self.spec['landmark']) # we dont care, just populate the cache
-		except:
-			pass # record network failure later...
 
 	def toDict(self):
 		return self.spec
 
+	def hostnames(self):
+		return [self.spec['landmark']]
+
 	# actually perform the measurements, no arguments required
 	def run(self):
+		self.resolve()
 		logger.info("HTTPinging: %s @ %f, PID: %d" % (self.spec['landmark'], time.time(), os.getpid()))
 		self.measure(self.spec['landmark'], self.spec['ping_count'])
 
 
 	#main measure funtion
 	def measure(self, landmark, ping_count):
-		start_time = cp.utils.now()
-		op_output = self.perform(landmark, ping_count)
-		end_time = cp.utils.now()
-		logger.debug(op_output)
-		if op_output!=None:
-			self.parse_output(op_output, landmark, start_time, end_time, ping_count)
-		self.dao.write_op("httping", self.spec)
+		self.run_command()
 
-	#ping function
-	def perform(self, landmark, ping_count):
-		command = "httping -S -c %s %s" % (ping_count, landmark)
-		logging.info("Executing: "+command)
-		self.spec['return_code'], output = self.execute(command)
-		#print self.spec['return_code'], output
-		if self.spec['return_code']==0:
-			return output
-		return None
+	def command(self):
+		return "httping -S -c %s %s" % (self.spec['ping_count'], self.spec['landmark'])
+
+	def record(self, return_code, output, start_time, end_time):
+		self.spec['return_code'] = return_code
+		logger.debug(output)
+		if return_code==0:
+			self.parse_output(output, self.spec['landmark'], start_time, end_time, self.spec['ping_count'])
+		self.dao.write_op("httping", self.spec)
 
 	# average out the breakdowns if different steps in HTTP request
 	def parse_breakdowns(self, breakdowns):
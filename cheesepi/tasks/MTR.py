@@ -1,5 +1,6 @@
 import time
 import os
+import uuid
 
 import cheesepi as cp
 import Task
@@ -18,23 +19,21 @@ class MTR(Task.Task):
 		self.measure(self.spec['landmark'])
 
 	def measure(self, landmark):
-		#Extract the ethernet MAC address of the PI
-		startTime = cp.utils.now()
-		output    = self.perform(landmark)
-		endTime   = cp.utils.now()
-
-		logger.debug(output)
-		hops = self.parse(output, startTime, endTime)
-		self.insertData(self.dao, hops)
+		self.run_command()
 
 	#Execute traceroute function
-	def perform(self, target, count=10):
+	def command(self, count=10):
 		#traceroute command"
-		command = "mtr  --report-wide -c%d %s"%(count,target)
-		self.spec['return_code'], output = self.execute(command)
-		if self.spec['return_code']==0:
-			return output
-		return None
+		return "mtr  --report-wide -c%d %s"%(count,self.spec['landmark'])
+
+	def record(self, return_code, output, start_time, end_time):
+		self.spec['return_code'] = return_code
+		logger.debug(output)
+		if return_code!=0:
+			logger.error("MTR to %s failed with code %d" % (self.spec['landmark'], return_code))
+			return
+		hops = self.parse(output, start_time, end_time)
+		self.insertData(self.dao, hops)
 
 	def parse(self, data, start_time, end_time):
 		self.spec['start'] = start_time
@@ -67,12 +66,16 @@ class MTR(Task.Task):
 	#insert the mtr results into the database
 	def insertData(self, dao, hoplist):
 		logger.debug("Writting to the MTR table")
-		mtr_id = dao.write_op("mtr", self.spec)
+		# the hops refer to an id of our own, a buffered DAO does not
+		# return the id of the stored op
+		mtr_id = uuid.uuid4().hex
+		self.spec['mtr_id'] = mtr_id
+		dao.write_op("mtr", self.spec)
 
 		for hop in hoplist:
 			logger.debug(hop)
 			hop['mtr_id'] = mtr_id
-			dao.write_op("mtr_hop",hop)
+		dao.write_ops("mtr_hop", hoplist)
 
 
 #parses arguments
@@ -1,11 +1,11 @@
 import time
 import os
 import re
-import logging
-import socket
 
 import cheesepi as cp
 import Task
+import icmp
+from cheesepi import codec
 
 logger = cp.config.get_logger(__name__)
 
@@ -15,40 +15,144 @@ class Ping(Task.Task):
 	def __init__(self, dao, spec):
 		Task.Task.__init__(self, dao, spec)
 		self.spec['taskname']    = "ping"
-		if not 'landmark'    in self.spec: self.spec['landmark']    = "www.sics.se"
 		if not 'ping_count'  in self.spec: self.spec['ping_count']  = 10
 		if not 'packet_size' in self.spec: self.spec['packet_size'] = 64
-		try:
-			socket.gethostbyname(self.spec['landmark']) # we dont care, just populate the cache
-		except:
-			pass # record ping failure later
+		# 'native' pings from this process, 'system' runs the ping binary
+		if not 'engine'      in self.spec: self.spec['engine']      = "native"
+		# 'binary' packs delays (see cheesepi.codec), 'text' is the list's repr
+		if not 'delay_encoding' in self.spec: self.spec['delay_encoding'] = "binary"
+		if self.multi_target():
+			return
+		if not 'landmark'    in self.spec: self.spec['landmark']    = "www.sics.se"
+
+	def multi_target(self):
+		return 'landmarks' in self.spec or 'targets' in self.spec
+
+	def hostnames(self):
+		if self.multi_target():
+			return [] # resolved by the ICMP engine
+		return [self.spec['landmark']]
 
 	# actually perform the measurements, no arguments required
 	def run(self):
+		self.resolve()
+		if self.multi_target():
+			logger.info("Pinging %d targets @ %f, PID: %d" % (len(self.get_target_ops()), time.time(), os.getpid()))
+			self.measure_many()
+			return
 		logger.info("Pinging: %s @ %f, PID: %d" % (self.spec['landmark'], time.time(), os.getpid()))
 		self.measure()
 
+	def get_target_ops(self):
+		"""One op per target of a multi target spec. Targets are given as
+		'landmarks', a list of domains, and/or as 'targets', a list of
+		entity dicts (as handed out by the server's scheduler)"""
+		base = dict(self.spec)
+		for key in ['landmarks', 'targets']:
+			base.pop(key, None)
+		ops = []
+		for landmark in self.spec.get('landmarks', []):
+			op = dict(base)
+			op['landmark'] = landmark
+			ops.append(op)
+		for target in self.spec.get('targets', []):
+			op = dict(base)
+			if target.get('type')=="landmark":
+				op['landmark'] = target['domain']
+			else:
+				op['target_id'] = target['uuid']
+				op['target_address'] = target['ip']
+			ops.append(op)
+		return ops
+
+	def destination(self):
+		"""Who should this op ping?"""
+		if 'landmark' in self.spec:
+			return self.spec['landmark']
+		return self.spec['target_address']
+
+	def measure_many(self):
+		"""Probe all targets interleaved (if pinging natively, otherwise one
+		after the other), and store one op per target in a single write"""
+		spec = self.spec
+		ops = self.get_target_ops()
+		if self.native():
+			destinations = []
+			for op in ops:
+				self.spec = op
+				destinations.append(self.destination())
+			start_time = cp.utils.now()
+			results = icmp.ping(destinations, self.spec['ping_count'], self.spec['packet_size'])
+			end_time = cp.utils.now()
+			for op, result in zip(ops, results):
+				self.spec = op
+				self.record_native(result, start_time, end_time)
+		else:
+			for op in ops:
+				self.spec = op
+				start_time = cp.utils.now()
+				return_code, output = self.execute(self.command())
+				end_time = cp.utils.now()
+				output = self.check_output(return_code, output)
+				if output!=None:
+					self.parse_output(output, self.destination(), start_time, end_time,
+						self.spec['packet_size'], self.spec['ping_count'])
+		self.spec = spec
+		# the targets share a start_time, each op needs its own point time
+		self.dao.stamp_ops(ops)
+		self.dao.write_ops(self.spec['taskname'], ops)
+
 	# measure and record funtion
 	def measure(self):
+		if self.native():
+			self.measure_native()
+		else:
+			self.run_command()
+
+	def native(self):
+		"""Should we use the in-process ICMP engine?"""
+		return self.spec['engine']=="native" and icmp.available()
+
+	def measure_native(self):
 		start_time = cp.utils.now()
-		op_output = self.perform(self.spec['landmark'], self.spec['ping_count'], self.spec['packet_size'])
+		result = icmp.ping([self.destination()], self.spec['ping_count'], self.spec['packet_size'])[0]
 		end_time = cp.utils.now()
+		logger.debug(result)
+		self.record_native(result, start_time, end_time)
+		self.dao.write_op(self.spec['taskname'], self.spec)
 
+	def record_native(self, result, start_time, end_time):
+		"""Store the fields of an icmp.ping() result"""
+		self.spec.update(result)
+		self.spec["start_time"] = start_time
+		self.spec["end_time"]   = end_time
+		if 'delays' in result:
+			self.spec['delays']     = self.encode_delays(result['delays'])
+			self.spec['uploaded']   = self.spec['packet_size'] * self.spec['ping_count']
+			self.spec['downloaded'] = 8 * self.spec['ping_count']
+
+	def encode_delays(self, delays):
+		if self.spec['delay_encoding']=="binary":
+			return codec.encode_delays(delays)
+		return str(delays)
+
+	def command(self):
+		if self.native() or self.multi_target():
+			return None # measured in-process, see measure_native()/measure_many()
+		packet_size = self.spec['packet_size'] - 8 # change packet size to payload length!
+		return "ping -c %s -s %s %s"%(self.spec['ping_count'], packet_size, self.destination())
+
+	def record(self, return_code, output, start_time, end_time):
+		op_output = self.check_output(return_code, output)
 		logger.debug(op_output)
 		if op_output!=None: # we succeeded
-			self.parse_output(op_output, self.spec['landmark'],
+			self.parse_output(op_output, self.destination(),
 				start_time, end_time, self.spec['packet_size'], self.spec['ping_count'])
 		self.dao.write_op(self.spec['taskname'], self.spec)
 
-
-	#ping function
-	def perform(self, landmark, ping_count, packet_size):
-		packet_size -= 8 # change packet size to payload length!
-		command = "ping -c %s -s %s %s"%(ping_count, packet_size, landmark)
-		logging.info("Executing: "+command)
-		logger.info(command)
-		self.spec['return_code'], output = self.execute(command)
-
+	def check_output(self, return_code, output):
+		"""Return the ping output, or None (noting the error) if it failed"""
+		self.spec['return_code'] = return_code
 		if self.spec['return_code']==0:
 			return output
 		elif self.spec['return_code']==68:
@@ -78,8 +182,8 @@ class Ping(Task.Task):
 				elif "icmp_seq" in line: # Linux counts from 0
 					sequence_num = int(re.findall('icmp_.eq=[\d]+ ',line)[0][9:-1])
 				else:
-					logging.error("ping parse error:"+line)
-					exit(1)
+					logger.error("ping parse error:"+line)
+					continue
 				delay = re.findall('time=.*? ms',line)[0][5:-3]
 				# only save returned pings!
 				delays[sequence_num-1]=float(delay)
@@ -93,7 +197,7 @@ class Ping(Task.Task):
 				self.spec["maximum_RTT"] = float(fields[2])
 				self.spec["stddev_RTT"]  = float(fields[3])
 
-		self.spec['delays']     = str(delays)
+		self.spec['delays']     = self.encode_delays(delays)
 		self.spec['uploaded']   = self.spec['packet_size'] * self.spec['ping_count']
 		self.spec['downloaded'] = 8 * self.spec['ping_count']
 
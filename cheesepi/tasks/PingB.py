@@ -1,5 +1,6 @@
 import time
 import os
+import uuid
 
 import cheesepi as cp
 import Task
@@ -67,12 +68,16 @@ class PingB(Task.Task):
 	#insert the mtr results into the database
 	def insertData(self, dao, hoplist):
 		logger.debug("Writting to the PingB table")
-		mtr_id = dao.write_op("pingb", self.spec)
+		# the hops refer to an id of our own, a buffered DAO does not
+		# return the id of the stored op
+		pingb_id = uuid.uuid4().hex
+		self.spec['pingb_id'] = pingb_id
+		dao.write_op("pingb", self.spec)
 
 		for hop in hoplist:
 			logger.debug(hop)
-			hop['pingb_id'] = mtr_id
-			dao.write_op("pingb_hop",hop)
+			hop['pingb_id'] = pingb_id
+		dao.write_ops("pingb_hop", hoplist)
 
 
 #parses arguments
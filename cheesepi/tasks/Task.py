@@ -1,5 +1,6 @@
 import random
 import json
+import socket
 from subprocess import Popen, PIPE
 
 import cheesepi as cp
@@ -34,9 +35,39 @@ class Task:
 		result = Popen(program, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True)
 		result.stdout.flush()
 		output = result.stdout.read()
-		result.poll() # set return code
+		result.wait() # set return code
 		return result.returncode, output
 
+	# Subprocess based tasks override command() to return the shell command
+	# performing their measurement, and record() to parse and store its
+	# output. An event driven dispatcher can then run the command without
+	# blocking on it
+	def command(self):
+		return None
+
+	def record(self, return_code, output, start_time, end_time):
+		pass
+
+	# Hostnames the measurement looks up, resolved before it starts (see
+	# resolve()). An event driven dispatcher resolves them without blocking
+	def hostnames(self):
+		return []
+
+	def resolve(self):
+		"""Look up hostnames(), we dont care, just populate the cache"""
+		for hostname in self.hostnames():
+			try:
+				socket.gethostbyname(hostname)
+			except socket.error:
+				pass # record the failure when measuring
+
+	def run_command(self):
+		"""Execute command() and record() its output"""
+		start_time = cp.utils.now()
+		return_code, output = self.execute(self.command())
+		end_time = cp.utils.now()
+		self.record(return_code, output, start_time, end_time)
+
 	# this will be overridden by subclasses
 	def run(self):
 		print "Task not doing anything..."
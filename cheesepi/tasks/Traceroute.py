@@ -2,6 +2,7 @@ import time
 import os
 import platform
 import re
+import uuid
 
 import cheesepi as cp
 import Task
@@ -20,25 +21,23 @@ class Traceroute(Task.Task):
 		self.measure(self.spec['landmark'])
 
 	def measure(self, landmark):
-		#Extract the ethernet MAC address of the PI
-		startTime = cp.utils.now()
-		output    = self.perform(landmark)
-		endTime   = cp.utils.now()
-		#trc, hoplist = reformat(tracerouteResult, startTime, endTime)
-		logger.debug(output)
-		parsed = self.parse(output, startTime, endTime)
-		parsed['uploaded']= 8 * 3 * len(parsed['hops'])
-		parsed['uploaded']= parsed['downloaded']
-		self.insertData(self.dao, parsed['traceroute'], parsed['hops'])
+		self.run_command()
 
 	#Execute traceroute function
-	def perform(self, target):
+	def command(self):
 		#traceroute command"
-		command = "traceroute %s"%(target)
-		self.spec['return_code'], output = self.execute(command)
-		if self.spec['return_code']==0:
-			return output
-		return None
+		return "traceroute %s"%(self.spec['landmark'])
+
+	def record(self, return_code, output, start_time, end_time):
+		self.spec['return_code'] = return_code
+		logger.debug(output)
+		if return_code!=0:
+			logger.error("Traceroute to %s failed with code %d" % (self.spec['landmark'], return_code))
+			return
+		parsed = self.parse(output, start_time, end_time)
+		parsed['traceroute']['uploaded']   = 8 * 3 * len(parsed['hops'])
+		parsed['traceroute']['downloaded'] = parsed['traceroute']['uploaded']
+		self.insertData(self.dao, parsed['traceroute'], parsed['hops'])
 
 	def parse_null(self, hop_count):
 		return {'hop_count': hop_count,
@@ -140,13 +139,17 @@ class Traceroute(Task.Task):
 	#insert the tracetoute results into the database
 	def insertData(self, dao, traceroute, hoplist):
 		logger.debug("Writting to the Traceroute table")
-		traceroute_id = dao.write_op("traceroute", traceroute)
+		# the hops refer to an id of our own, a buffered DAO does not
+		# return the id of the stored op
+		traceroute_id = uuid.uuid4().hex
+		traceroute['traceroute_id'] = traceroute_id
+		dao.write_op("traceroute", traceroute)
 
 		for hop in hoplist:
 			logger.debug(hop)
 			#hop.traceroute = traceroute_id
 			hop['traceroute_id'] = traceroute_id
-			dao.write_op("traceroute_hop",hop)
+		dao.write_ops("traceroute_hop", hoplist)
 
 
 #parses arguments
@@ -1,17 +1,28 @@
 import time
 import os
+import json
+import shutil
+import hashlib
 import tarfile
 import tempfile
 import StringIO
 import requests
 import sys
 import argparse
+from collections import OrderedDict
 
 import cheesepi as cp
 import Task
+from cheesepi import codec
+from cheesepi import compression
 
 logger = cp.config.get_logger(__name__)
 
+# A dump that has not been completely uploaded yet, and its dump marks
+pending_file       = os.path.join(cp.config.home_dir, ".cheesepi.upload.tgz")
+pending_marks_file = pending_file+".marks"
+timeout = 60 # seconds to wait for the collector on each request
+
 
 class Upload(Task.Task):
 	"""Task to upload data to central server.
@@ -24,6 +35,25 @@ class Upload(Task.Task):
 		if not 'collector' in self.spec: # no special endpoint
 			if not 'server' in self.spec: self.spec['server'] = cp.config.get_controller()
 			self.spec['collector'] = self.spec['server']+"/upload.py"
+		# dump in time ordered chunks from where the last upload ended,
+		# rather than whole series in memory
+		if not 'stream' in self.spec:     self.spec['stream'] = True
+		if not 'chunk_size' in self.spec: self.spec['chunk_size'] = 1000
+		# format of streamed chunks: 'json' (as InfluxDB query results) or
+		# 'columns' (see cheesepi.codec, only newer collectors read it)
+		if not 'format' in self.spec:     self.spec['format'] = "json"
+		# archive compression, one of compression.CODECS ('xz' and 'zstd'
+		# need optional modules, and newer collectors) at compression_level
+		# (None for the codec's default)
+		if not 'compression' in self.spec: self.spec['compression'] = "gz"
+		if not 'compression_level' in self.spec: self.spec['compression_level'] = None
+		if not compression.available(self.spec['compression']):
+			logger.warning("Compression %s not available, using gz" % self.spec['compression'])
+			self.spec['compression'] = "gz"
+			self.spec['compression_level'] = None
+		# upload in resumable pieces of upload_chunk_bytes
+		if not 'chunked' in self.spec:    self.spec['chunked'] = True
+		if not 'upload_chunk_bytes' in self.spec: self.spec['upload_chunk_bytes'] = 262144
 
 	def run(self):
 		"""Upload data server, may take some time..."""
@@ -40,43 +70,182 @@ class Upload(Task.Task):
 			logger.info("Last dumped DB: "+str(last_dumped))
 		print "Last dumped DB: "+str(last_dumped)
 
-		dumped_tables = self.dao.dump(last_dumped)
-		logger.debug(dumped_tables)
 		ethmac = cp.utils.getCurrMAC()
 		parameters = {'ethmac': ethmac}
 
+		chunked = upload and self.spec['chunked']
+		if chunked and os.path.isfile(pending_file):
+			# finish sending the last dump before making another
+			if self.upload_pending()==None:
+				return None
+
 		fd=None
-		if store_file:
+		if chunked:
+			# kept on disk until the collector has all of it
+			fd = open(pending_file+".tmp", 'w+b')
+		elif store_file:
 			filename=str(int(time.time()))
 			fd = open(filename+".tgz",'w')
 		else:
 			# make a temp file that disappears outside of scope
 			fd = tempfile.TemporaryFile()
 
-		# make a zipfile object with this file handle
-		tar = tarfile.open(fileobj=fd, mode="w:gz")
-
-		for table in dumped_tables.keys():
-			#print table
-			table_info = tarfile.TarInfo(name=table+".json")
-			table_info.size=len(dumped_tables[table])
-			tar.addfile(table_info, StringIO.StringIO(dumped_tables[table]))
-		tar.close()
+		marks = None
+		if self.spec['stream']:
+			marks = self.write_chunks(fd, last_dumped)
+		else:
+			self.write_tables(fd, last_dumped)
 		fd.flush()
 		fd.seek(0) # flush and reset file handle, so it can be read for POST
 
+		if chunked:
+			fd.close()
+			if store_file:
+				shutil.copyfile(pending_file+".tmp", str(int(time.time()))+".tgz")
+			with open(pending_marks_file, 'w') as f:
+				json.dump(marks, f)
+			os.rename(pending_file+".tmp", pending_file)
+			return self.upload_pending()
+
 		if upload:
 			files = {'file': ('archive.tgz', fd), }
 			try:
 				r = requests.post("http://"+self.spec['collector'], data=parameters, files=files)
+				r.raise_for_status()
 				logger.debug("Uploaded, with response: "+r.text)
 				print "Uploaded, with response: "+r.text
 				cp.config.set_last_dumped() # record that we successfully dumped
+				if marks!=None: # next dump starts where this one ended
+					cp.config.set_dump_marks(marks)
 				return r.text
 			except:
 				logger.error("Failed to upload data dump")
 		return None
 
+	def upload_pending(self):
+		"""Upload the pending dump, continuing from wherever a previous
+		attempt got to, and then record its dump marks"""
+		marks = None
+		try:
+			with open(pending_marks_file) as f:
+				marks = json.load(f)
+		except (IOError, ValueError) as e:
+			logger.warning("No dump marks for pending upload: "+str(e))
+		try:
+			response = self.upload_chunked(pending_file)
+		except Exception as e:
+			logger.error("Failed to upload data dump, will resume next time: "+str(e))
+			return None
+		logger.debug("Uploaded, with response: "+response)
+		print "Uploaded, with response: "+response
+		cp.config.set_last_dumped() # record that we successfully dumped
+		if marks!=None: # next dump starts where this one ended
+			cp.config.set_dump_marks(marks)
+		os.remove(pending_file)
+		if os.path.isfile(pending_marks_file):
+			os.remove(pending_marks_file)
+		return response
+
+	def upload_chunked(self, filename):
+		"""POST filename in pieces, each with its offset in the file, then
+		ask the collector to check the MD5 of the whole. The MD5 is also
+		the upload_id, which the collector tells us how much of it has
+		already been received. Falls back to a single POST for collectors
+		that do not take chunks."""
+		url = "http://"+self.spec['collector']
+		md5_hash = md5_file(filename)
+		r = requests.get(url, params={'upload_id': md5_hash}, timeout=timeout)
+		r.raise_for_status()
+		try:
+			offset = int(r.text)
+		except ValueError:
+			logger.info("Collector does not take chunked uploads")
+			with open(filename, 'rb') as fd:
+				files = {'file': ('archive.tgz', fd), }
+				r = requests.post(url, data={'ethmac': cp.utils.getCurrMAC()}, files=files, timeout=timeout)
+			r.raise_for_status()
+			return r.text
+
+		size = os.path.getsize(filename)
+		if offset > 0:
+			logger.info("Resuming upload at byte %d of %d" % (offset, size))
+		with open(filename, 'rb') as fd:
+			while offset < size:
+				fd.seek(offset)
+				chunk = fd.read(self.spec['upload_chunk_bytes'])
+				r = requests.post(url, params={'upload_id': md5_hash, 'offset': offset},
+					data=chunk, headers={'Content-Type': 'application/octet-stream'}, timeout=timeout)
+				if r.status_code!=409: # 409 says where to continue from instead
+					r.raise_for_status()
+				offset = int(r.text)
+
+		parameters = {
+			'upload_id': md5_hash,
+			'complete':  1,
+			'md5_hash':  md5_hash,
+			'filename':  os.path.basename(filename).lstrip("."),
+			'ethmac':    cp.utils.getCurrMAC(),
+		}
+		r = requests.post(url, params=parameters, timeout=timeout)
+		r.raise_for_status()
+		return r.text
+
+	def open_archive(self, fd):
+		"""A tar archive writing into fd, compressed as the spec says.
+		Returns the archive and the compressed stream, close both (in
+		that order) to finish writing, fd is left open"""
+		stream = compression.compressor(fd, self.spec['compression'], self.spec['compression_level'])
+		return tarfile.open(fileobj=stream, mode="w|"), stream
+
+	def write_tables(self, fd, last_dumped):
+		"""Write whole series dumped since last_dumped into an archive"""
+		dumped_tables = self.dao.dump(last_dumped)
+		logger.debug(dumped_tables)
+		tar, stream = self.open_archive(fd)
+
+		for table in dumped_tables.keys():
+			#print table
+			table_info = tarfile.TarInfo(name=table+".json")
+			table_info.size=len(dumped_tables[table])
+			tar.addfile(table_info, StringIO.StringIO(dumped_tables[table]))
+		tar.close()
+		stream.close()
+
+	def write_chunks(self, fd, last_dumped):
+		"""Stream every series into an archive, one member per chunk, so only
+		one chunk is held in memory. Series continue from their dump mark
+		(or last_dumped if they have none). Returns the new marks."""
+		marks = cp.config.get_dump_marks()
+		tar, stream = self.open_archive(fd)
+		chunk_count = {}
+		for series, columns, values, high_water in self.dao.dump_chunks(marks, last_dumped, self.spec['chunk_size']):
+			chunk_count[series] = chunk_count.get(series, 0) + 1
+			if self.spec['format']=="columns":
+				data = codec.pack_columns(series, columns, values)
+				extension = "col"
+			else:
+				# same layout as an InfluxDB 0.9 query result, with name and
+				# columns first so the collector can stream through the values
+				chunk = OrderedDict([('name',series), ('columns',columns), ('values',values)])
+				data = json.dumps([{'series': [chunk]}])
+				extension = "json"
+			chunk_info = tarfile.TarInfo(name="%s.%d.%s" % (series, chunk_count[series], extension))
+			chunk_info.size  = len(data)
+			chunk_info.mtime = time.time()
+			tar.addfile(chunk_info, StringIO.StringIO(data))
+			marks[series] = high_water
+		tar.close()
+		stream.close()
+		logger.info("Dumped chunks: "+str(chunk_count))
+		return marks
+
+
+def md5_file(filename):
+	md5 = hashlib.md5()
+	with open(filename, 'rb') as fd:
+		for block in iter(lambda: fd.read(65536), ""):
+			md5.update(block)
+	return md5.hexdigest()
 
 
 if __name__ == "__main__":
@@ -33,8 +33,7 @@ class Wifi(Task.Task):
 		logger.debug(parsed_output)
 		scan_digest = self.digest_scan(parsed_output)
 		self.dao.write_op("wifi_scan", scan_digest)
-		for ap in parsed_output:
-			dao.write_op("wifi_ap", ap)
+		self.dao.write_ops("wifi_ap", parsed_output)
 
 	def perform(self):
 		try:
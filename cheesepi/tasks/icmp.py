@@ -0,0 +1,228 @@
+""" Copyright (c) 2015, Swedish Institute of Computer Science
+  All rights reserved.
+  Redistribution and use in source and binary forms, with or without
+  modification, are permitted provided that the following conditions are met:
+	  * Redistributions of source code must retain the above copyright
+		notice, this list of conditions and the following disclaimer.
+	  * Redistributions in binary form must reproduce the above copyright
+		notice, this list of conditions and the following disclaimer in the
+		documentation and/or other materials provided with the distribution.
+	  * Neither the name of The Swedish Institute of Computer Science nor the
+		names of its contributors may be used to endorse or promote products
+		derived from this software without specific prior written permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+ WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+ DISCLAIMED. IN NO EVENT SHALL THE SWEDISH INSTITUTE OF COMPUTER SCIENCE BE LIABLE
+ FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+ (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+ LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Authors: ljjm@sics.se
+Testers:
+Description: In-process ICMP echo engine, so pinging does not fork a shell
+and a ping binary per landmark. Uses an unprivileged ICMP datagram socket
+where the kernel permits it (see net.ipv4.ping_group_range on Linux),
+otherwise a raw socket (which requires root). Any number of targets are
+probed concurrently from the one socket.
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+import struct
+
+import cheesepi as cp
+
+logger = cp.config.get_logger(__name__)
+
+ICMP_ECHO_REPLY   = 0
+ICMP_ECHO_REQUEST = 8
+HEADER_SIZE = 8 # bytes of ICMP header
+# payload starts with the send time in nanoseconds and a per run token
+PAYLOAD_FORMAT = "!Q4s"
+PAYLOAD_SIZE   = struct.calcsize(PAYLOAD_FORMAT)
+# wire sequence numbers are 16 bits, so at most this many probes per run
+MAX_PROBES = 0x10000
+
+_available = None # cached result of available()
+
+
+def open_socket():
+	"""Return (socket, is_raw), raising socket.error if ICMP is not permitted"""
+	try:
+		return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+	except socket.error:
+		return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True
+
+def available():
+	"""Can this process open an ICMP socket?"""
+	global _available
+	if _available==None:
+		try:
+			sock, is_raw = open_socket()
+			sock.close()
+			_available = True
+		except socket.error as e:
+			logger.info("No ICMP socket available (%s), using the ping binary" % e)
+			_available = False
+	return _available
+
+def now_ns():
+	"""Current time in integer nanoseconds. The seconds and the fraction
+	are converted apart, a double of the whole count would round it"""
+	now = time.time()
+	seconds = int(now)
+	return seconds * 10**9 + int((now - seconds) * 10**9)
+
+def checksum(data):
+	"""Internet checksum of data (RFC 1071)"""
+	if len(data) % 2:
+		data += b"\x00"
+	total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+	total = (total >> 16) + (total & 0xffff)
+	total += total >> 16
+	return ~total & 0xffff
+
+def build_request(identifier, sequence, token, packet_size):
+	"""Echo request of packet_size bytes (ICMP header included)"""
+	payload = struct.pack(PAYLOAD_FORMAT, now_ns(), token)
+	payload += b"\x00" * max(0, packet_size - HEADER_SIZE - PAYLOAD_SIZE)
+	header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+	header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0,
+		checksum(header + payload), identifier, sequence)
+	return header + payload
+
+def parse_reply(data, is_raw):
+	"""Return (sequence, sent_ns, token) of an echo reply, None otherwise"""
+	if is_raw: # raw sockets also deliver the IP header
+		data = data[(ord(data[0]) & 0x0f) * 4:]
+	if len(data) < HEADER_SIZE + PAYLOAD_SIZE:
+		return None
+	icmp_type, code, chk, identifier, sequence = struct.unpack("!BBHHH", data[:HEADER_SIZE])
+	if icmp_type != ICMP_ECHO_REPLY:
+		return None
+	sent_ns, token = struct.unpack(PAYLOAD_FORMAT, data[HEADER_SIZE:HEADER_SIZE+PAYLOAD_SIZE])
+	return sequence, sent_ns, token
+
+def summarise(domain, address, delays):
+	"""Build the same fields that Ping parses from the ping binary's output"""
+	result = {
+		'destination_domain':  domain,
+		'destination_address': address,
+		'delays': delays,
+	}
+	received = [d for d in delays if d >= 0]
+	if len(delays) > 0:
+		result['packet_loss'] = 100.0 * (len(delays) - len(received)) / len(delays)
+	else:
+		result['packet_loss'] = 0.0 # nothing was sent
+	if len(received)==0:
+		result['error'] = "No response"
+		return result
+	mean = sum(received) / len(received)
+	result['minimum_RTT'] = min(received)
+	result['average_RTT'] = mean
+	result['maximum_RTT'] = max(received)
+	# population standard deviation, as ping's mdev
+	result['stddev_RTT']  = (sum((d-mean)**2 for d in received) / len(received)) ** 0.5
+	return result
+
+def ping(targets, count=10, packet_size=64, interval=1.0, timeout=2.0):
+	"""Ping every target in targets count times, probes to all targets are
+	interleaved every interval seconds. Waits up to timeout seconds for
+	the last replies. Returns a list of result dicts (see summarise()) in
+	the order of targets, with 'error' set for unresolvable targets."""
+	batch_size = max(1, MAX_PROBES // max(count, 1))
+	if len(targets) > batch_size:
+		# more probes than wire sequences, ping the targets a batch at a time
+		results = []
+		for start in xrange(0, len(targets), batch_size):
+			results.extend(ping(targets[start:start+batch_size], count,
+				packet_size, interval, timeout))
+		return results
+
+	addresses = []
+	for target in targets:
+		try:
+			addresses.append(socket.gethostbyname(target))
+		except socket.error:
+			addresses.append(None)
+
+	sock, is_raw = open_socket()
+	sock.setblocking(0)
+	identifier = os.getpid() & 0xffff # datagram sockets use their own
+	token = os.urandom(4) # ignore replies to other processes' probes
+
+	delays = [[-1.0] * count for t in targets]
+	# each probe has its own sequence number on the wire, to tell apart
+	# targets that resolve to the same address
+	waiting = {} # wire sequence -> (target index, probe number)
+	def wire_sequence(i, seq):
+		return (i * count + seq) % MAX_PROBES
+	for i in xrange(len(targets)):
+		if addresses[i] != None:
+			for seq in xrange(count):
+				waiting[wire_sequence(i, seq)] = (i, seq)
+
+	def receive(until):
+		while len(waiting) > 0:
+			remaining = until - time.time()
+			if remaining <= 0:
+				return
+			readable, w, x = select.select([sock], [], [], remaining)
+			if not readable:
+				return
+			try:
+				data, source = sock.recvfrom(65535)
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EINTR):
+					continue
+				raise
+			received_ns = now_ns()
+			reply = parse_reply(data, is_raw)
+			if reply==None or reply[2]!=token:
+				continue
+			sequence, sent_ns, t = reply
+			if sequence not in waiting or addresses[waiting[sequence][0]]!=source[0]:
+				continue
+			i, seq = waiting.pop(sequence)
+			delays[i][seq] = (received_ns - sent_ns) / 1e6 # milliseconds
+
+	try:
+		next_round = time.time()
+		for seq in xrange(count):
+			for i in xrange(len(targets)):
+				if addresses[i] == None:
+					continue
+				try:
+					request = build_request(identifier, wire_sequence(i, seq), token, packet_size)
+					sock.sendto(request, (addresses[i], 0))
+				except socket.error as e:
+					logger.warning("Sending echo request to %s failed: %s" % (addresses[i], e))
+			next_round += interval
+			if seq < count-1:
+				receive(next_round)
+		receive(time.time() + timeout)
+	finally:
+		sock.close()
+
+	results = []
+	for i in xrange(len(targets)):
+		if addresses[i] == None:
+			results.append({'destination_domain': targets[i], 'error': "Unknown host"})
+		else:
+			results.append(summarise(targets[i], addresses[i], delays[i]))
+	return results
+
+
+if __name__ == "__main__":
+	import sys
+	from pprint import pprint
+	pprint(ping(sys.argv[1:] or ["www.sics.se"], count=3))
@@ -0,0 +1,126 @@
+"""
+Compression ratio and CPU time of the upload archive codecs (see
+cheesepi.compression), to pick one for a deployment. Runs on existing
+dumps (made with Upload.py --no-upload --store-file) or, without any, on
+generated ping dumps in both upload formats.
+"""
+from __future__ import unicode_literals, absolute_import, print_function
+
+import io
+import os
+import json
+import random
+import tarfile
+import argparse
+from collections import OrderedDict
+
+from cheesepi import codec
+from cheesepi import compression
+
+# (codec, level) pairs tried, those whose module is missing are skipped
+SETTINGS = [
+	("none", None),
+	("gz", 1), ("gz", 6), ("gz", 9),
+	("bz2", 9),
+	("xz", 0), ("xz", 6),
+	("zstd", 1), ("zstd", 3), ("zstd", 19),
+]
+
+PING_COLUMNS = ['time', 'peer_id', 'delays', 'landmark', 'target_id',
+	'destination_address', 'start_time', 'end_time', 'ping_count',
+	'packet_loss', 'packet_size', 'maximum_RTT', 'minimum_RTT',
+	'average_RTT', 'stddev_RTT']
+
+def cpu_time():
+	times = os.times()
+	return times[0] + times[1]
+
+def ping_rows(count, seed=0):
+	"""Rows like the ping series of a client measuring a few landmarks"""
+	rand = random.Random(seed)
+	landmarks = ["www.sics.se", "www.google.com", "www.bbc.co.uk", "www.kth.se"]
+	rows = []
+	start = 1500000000.0
+	for i in range(count):
+		base = rand.uniform(5, 80)
+		delays = [round(rand.gammavariate(2, 1.5) + base, 3)
+		          if rand.random() > 0.02 else -1.0 for j in range(10)]
+		received = [d for d in delays if d > 0] or [0.0]
+		mean = sum(received) / len(received)
+		rows.append([int((start + i) * 1e9), "b7f3c2a4-1111-2222-3333-444455556666",
+			codec.encode_delays(delays), landmarks[i % len(landmarks)], None,
+			"193.10.64.%d" % (i % len(landmarks)), start + i, start + i + 9.5,
+			10, 100.0 * (len(delays) - len(received)) / len(delays), 64,
+			max(received), min(received), mean,
+			(sum((d - mean) ** 2 for d in received) / len(received)) ** 0.5])
+	return rows
+
+def generated_dump(rows, upload_format, chunk_size=1000):
+	"""Uncompressed tar of rows, laid out as Upload.write_chunks does"""
+	fd = io.BytesIO()
+	tar = tarfile.open(fileobj=fd, mode="w|")
+	for n, start in enumerate(range(0, len(rows), chunk_size)):
+		values = rows[start:start + chunk_size]
+		if upload_format == "columns":
+			data = codec.pack_columns("ping", PING_COLUMNS, values)
+		else:
+			chunk = OrderedDict([('name', "ping"), ('columns', PING_COLUMNS), ('values', values)])
+			data = json.dumps([{'series': [chunk]}]).encode("utf-8")
+		info = tarfile.TarInfo(name="ping.%d.%s" % (n + 1, "col" if upload_format == "columns" else "json"))
+		info.size = len(data)
+		tar.addfile(info, io.BytesIO(data))
+	tar.close()
+	return fd.getvalue()
+
+def read_dump(filename):
+	"""Uncompressed bytes of an archive, whatever it was compressed with"""
+	with open(filename, 'rb') as fd:
+		return compression.decompressor(fd, compression.detect_file(filename)).read()
+
+def compress(data, codec_name, level):
+	fd = io.BytesIO()
+	stream = compression.compressor(fd, codec_name, level)
+	stream.write(data)
+	stream.close()
+	return fd.getvalue()
+
+def decompress(data, codec_name):
+	return compression.decompressor(io.BytesIO(data), codec_name).read()
+
+def benchmark(name, data, repeat):
+	print("\n{} ({} bytes uncompressed)".format(name, len(data)))
+	print("{:<6} {:>5} {:>10} {:>7} {:>12} {:>14}".format(
+		"codec", "level", "bytes", "ratio", "compress s", "decompress s"))
+	for codec_name, level in SETTINGS:
+		if not compression.available(codec_name):
+			print("{:<6} {:>5} not available".format(codec_name, level))
+			continue
+		compress_time = decompress_time = float('inf')
+		for i in range(repeat):
+			start = cpu_time()
+			compressed = compress(data, codec_name, level)
+			compress_time = min(compress_time, cpu_time() - start)
+			start = cpu_time()
+			restored = decompress(compressed, codec_name)
+			decompress_time = min(decompress_time, cpu_time() - start)
+		assert restored == data
+		print("{:<6} {:>5} {:>10} {:>7.2f} {:>12.3f} {:>14.3f}".format(
+			codec_name, level if level is not None else "-", len(compressed),
+			float(len(data)) / len(compressed), compress_time, decompress_time))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark upload archive compression")
+	parser.add_argument('dumps', nargs='*', help="Dump archives to compress, generated ping dumps if none")
+	parser.add_argument('--rows', type=int, default=20000, help="Rows of the generated dumps")
+	parser.add_argument('--repeat', type=int, default=3, help="Runs per codec, the fastest is reported")
+	args = parser.parse_args()
+
+	if args.dumps:
+		for filename in args.dumps:
+			benchmark(filename, read_dump(filename), args.repeat)
+	else:
+		rows = ping_rows(args.rows)
+		for upload_format in ["json", "columns"]:
+			benchmark("{} ping rows, {} format".format(args.rows, upload_format),
+				generated_dump(rows, upload_format), args.repeat)
@@ -128,8 +128,22 @@ def upload_results(uuid, source_file, tar_dir):
 
 	response = requests.post(url, params, files=files)
 
+	# The upload is processed after the response, wait for it so that the
+	# statistics read next include its results
+	wait_for_processing()
+
 	return response
 
+def wait_for_processing(timeout=60):
+	url = 'http://localhost:18090/status'
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		status = requests.get(url).json()
+		if status['queued'] == 0 and status['processing'] == 0:
+			return
+		time.sleep(0.1)
+	print("Uploads still being processed after {} seconds".format(timeout))
+
 def update_stats_for_links(peer, iteration, old_stats, new_stats):
 	# In the data we don't want 0-indexing
 	index = iteration + 1
@@ -75,7 +75,7 @@ setup(
 		'speedtest-cli',
 	],
 	extras_require = {
-		'extra' : ['txmsgpackrpc','twisted','netifaces','pymongo'],
+		'extra' : ['txmsgpackrpc','twisted','netifaces','pymongo','ijson','numpy'],
 	},
 
 	entry_points={